@@ -0,0 +1,242 @@
+import asyncio
+from collections import OrderedDict
+import functools
+from typing import Callable, Coroutine, Dict, List, Optional, Set, Tuple
+
+from logger_code import LoggerBase
+from mqtt_code import async_publish_single
+
+
+class TokenBucket:
+    """Allows `rate` messages a second on average with bursts of up to `burst` messages."""
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float, count: float = 1) -> float:
+        """Seconds until `count` tokens are available."""
+        self._refill(now)
+        missing = count - self.tokens
+        # Rounding can leave a shortfall so small that waiting it out doesn't move the clock on, and the wait would
+        # then come round again forever.
+        return missing / self.rate if missing > 1e-9 else 0.0
+
+    def take(self, now: float, count: float = 1):
+        self._refill(now)
+        self.tokens -= count
+
+
+class _Command:
+    __slots__ = ("hostname", "messages", "logger", "publish", "future", "submitted")
+
+    def __init__(self, hostname, messages, logger, publish, future, submitted):
+        self.hostname = hostname
+        self.messages = messages
+        self.logger = logger
+        self.publish = publish
+        self.future = future
+        self.submitted = submitted
+
+
+class ActuationScheduler:
+    """
+    Sits between GrowTentEnv.turn_on_power and the MQTT layer.  Commands for each plug are queued per broker and device
+    (the topic without its last part, e.g. cmnd/mistbuddy_fan) and started by one worker that rate limits with a token
+    bucket per broker and one per plug, so a burst of readings from many tents doesn't turn into a burst of publishes
+    the Tasmota plugs drop.  Each command is published in its own task, so a plug or broker that doesn't answer only
+    holds up the next command for that same device.  A device's next command starts once its last one is done.
+
+    A device never has more than one command waiting.  If a new one comes in before the waiting one went out, the new
+    one replaces it (its seconds_on is the more up to date) and both callers are told when it is sent.  Devices are
+    served in the order their commands came in, so the scheduling delay of any command is at most one round through the
+    devices, plus however long its own device's previous command is still taking to publish.  worst_case_delay() works
+    out the first part.
+
+    submit() returns right away, so a reading is never held up behind another device's rate limit.  The scheduler keeps
+    the futures of the commands in flight and logs the ones that fail.
+    """
+    _shared: Optional["ActuationScheduler"] = None
+
+    @classmethod
+    def shared(cls) -> "ActuationScheduler":
+        """The scheduler all GrowTentEnvs in this process use."""
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def __init__(self, publish: Callable[..., Coroutine] = async_publish_single, broker_rate: float = 10, broker_burst: float = 10,
+                 plug_rate: float = 1, plug_burst: float = 2, max_delay: float = 30):
+        """
+        Args:
+            publish (Callable): How to publish one message.  Same signature as async_publish_single.
+            broker_rate (float): Messages per second to any one broker.
+            broker_burst (float): How many messages can go to a broker back to back.
+            plug_rate (float): Messages per second to any one plug.
+            plug_burst (float): How many messages can go to a plug back to back.  The Power and PulseTime pair is two.
+            max_delay (float): A warning is logged when the worst case scheduling delay goes over this many seconds.
+        """
+        self.logger = LoggerBase.setup_logger('ActuationScheduler')
+        self.publish = publish
+        self.broker_rate = broker_rate
+        self.broker_burst = broker_burst
+        self.plug_rate = plug_rate
+        self.plug_burst = plug_burst
+        self.max_delay = max_delay
+        # Keyed by (hostname, device):  the same topic on two brokers is two different plugs.
+        self._pending: "OrderedDict[Tuple[str, str], _Command]" = OrderedDict()
+        self._broker_buckets: Dict[str, TokenBucket] = {}
+        self._plug_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        # The publishing task of each device that has a command going out.
+        self._sending: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight: Set[asyncio.Future] = set()
+
+    @staticmethod
+    def device_of(topic: str) -> str:
+        return topic.rsplit("/", 1)[0]
+
+    def worst_case_delay(self, devices: Optional[int] = None, messages_per_command: int = 2) -> float:
+        """
+        The longest a command can wait to start going out:  every other device's command goes first at the broker rate,
+        then this plug's bucket may still need to refill.  Other devices' publishes run in their own tasks and don't add
+        to it.  The device's own previous command still publishing does, and is not counted.
+        """
+        devices = len(self._plug_buckets) if devices is None else devices
+        broker = max(0.0, devices * messages_per_command - self.broker_burst) / self.broker_rate
+        plug = messages_per_command / self.plug_rate
+        return broker + plug
+
+    @property
+    def in_flight(self) -> int:
+        """The number of commands submitted but not yet published or failed."""
+        return len(self._in_flight)
+
+    def submit(self, hostname: str, messages: List[Tuple[str, object]], logger=None, publish: Optional[Callable[..., Coroutine]] = None) -> asyncio.Future:
+        """
+        Queue the messages for one device.  Must be called from within the running event loop.
+
+        Args:
+            hostname (str): The broker.
+            messages (list): (topic, payload) pairs, published in order.  All topics belong to the same device.
+            logger (optional): Logger handed to the publish function.  Defaults to the scheduler's.
+            publish (Callable, optional): Publish function for this command.  Defaults to the scheduler's.
+
+        Returns:
+            asyncio.Future: Done once the messages have been published.  Awaiting it is optional.  A failure is logged
+                either way.
+        """
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+        device = self.device_of(messages[0][0])
+        key = (hostname, device)
+        if key not in self._plug_buckets:
+            self._plug_buckets[key] = TokenBucket(self.plug_rate, self.plug_burst, loop.time())
+            if self.worst_case_delay() > self.max_delay:
+                self.logger.warning(f"{len(self._plug_buckets)} plugs at {self.broker_rate} messages a second can delay a command by {self.worst_case_delay():.1f} seconds.")
+        waiting = self._pending.get(key)
+        if waiting is not None:
+            # Newer command wins.  It keeps the older one's place in line so the delay bound still holds.
+            waiting.messages = messages
+            waiting.publish = publish or self.publish
+            future = waiting.future
+        else:
+            future = loop.create_future()
+            self._in_flight.add(future)
+            future.add_done_callback(functools.partial(self._finished, device))
+            self._pending[key] = _Command(hostname, messages, logger or self.logger, publish or self.publish, future, loop.time())
+            self._wakeup.set()
+        return future
+
+    def _finished(self, device: str, future: asyncio.Future):
+        self._in_flight.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error(f"Publishing to {device} failed: {future.exception()}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            key, command, wait = self._next_ready(loop.time())
+            if command is None:
+                # Nothing can go yet.  Sleep until the soonest bucket has room, a publish finishes or a new command comes in.
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            del self._pending[key]
+            self._start(key, command, loop)
+
+    def _next_ready(self, now: float):
+        """
+        The first device in line that isn't still publishing and whose plug and broker have room.  If there is none,
+        the seconds until one will have room, or None if every device in line is waiting on its own publish.
+        """
+        soonest = None
+        for key, command in self._pending.items():
+            if key in self._sending:
+                continue
+            count = len(command.messages)
+            # A command longer than a burst goes out once a full burst is available.  The broker bucket then paces the rest.
+            plug_wait = self._plug_buckets[key].wait_time(now, min(count, self.plug_burst))
+            broker_wait = self._broker_bucket(command.hostname, now).wait_time(now, min(count, self.broker_burst))
+            wait = max(plug_wait, broker_wait)
+            if wait == 0:
+                return key, command, 0.0
+            soonest = wait if soonest is None else min(soonest, wait)
+        return None, None, soonest
+
+    def _broker_bucket(self, hostname: str, now: float) -> TokenBucket:
+        if hostname not in self._broker_buckets:
+            self._broker_buckets[hostname] = TokenBucket(self.broker_rate, self.broker_burst, now)
+        return self._broker_buckets[hostname]
+
+    def _start(self, key: Tuple[str, str], command: _Command, loop):
+        now = loop.time()
+        waited = now - command.submitted
+        if waited > self.max_delay:
+            self.logger.warning(f"Command for {key[1]} on {key[0]} waited {waited:.1f} seconds.")
+        # The tokens _next_ready checked for are taken now, before the next device is looked at.
+        first = min(len(command.messages), self.broker_burst)
+        self._plug_buckets[key].take(now, len(command.messages))
+        self._broker_bucket(command.hostname, now).take(now, first)
+        task = loop.create_task(self._send(command, int(first), loop))
+        self._sending[key] = task
+        task.add_done_callback(functools.partial(self._sent, key))
+
+    def _sent(self, key: Tuple[str, str], task: asyncio.Task):
+        del self._sending[key]
+        # The device may have another command waiting.
+        self._wakeup.set()
+
+    async def _send(self, command: _Command, paid: int, loop):
+        """Publish the messages in order.  The broker tokens for the first `paid` of them have already been taken."""
+        try:
+            for i, (topic, payload) in enumerate(command.messages):
+                if i >= paid:
+                    bucket = self._broker_bucket(command.hostname, loop.time())
+                    wait = bucket.wait_time(loop.time())
+                    if wait:
+                        await asyncio.sleep(wait)
+                    bucket.take(loop.time())
+                await command.publish(command.hostname, topic, payload, command.logger)
+        except Exception as e:
+            # _finished logs it.
+            if not command.future.done():
+                command.future.set_exception(e)
+            return
+        if not command.future.done():
+            command.future.set_result(None)
@@ -0,0 +1,333 @@
+"""
+Streaming importer for historical SnifferBuddy readings.  It reads
+
+    - InfluxDB annotated CSV exports of the snifferbuddy bucket, and
+    - telegraf stdout logs (JSON or line protocol lines, mixed with telegraf's own log lines),
+
+a fixed number of rows at a time, so a file of any size is parsed in constant memory.  Each chunk is turned into
+numpy columns and checked against SensorDataModel with array operations instead of one model per row.
+
+An export is grouped one series after another, so a tent with two SnifferBuddies has all of one sensor's readings
+before any of the other's.  The importer spools each tent's rows to disk as runs that are in timestamp order and merges
+the runs into the history store a chunk at a time.
+
+Example:
+    python src/backfill_code.py snifferbuddy_export.csv --history-dir history
+"""
+import argparse
+import csv
+from itertools import islice
+from json import loads
+import math
+import os
+import tempfile
+import time
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+from logger_code import LoggerBase
+from pydantic_models import SensorDataModel
+from sensor_history_code import COLUMNS, SensorHistoryStore
+
+FIELDS = list(SensorDataModel.model_fields)
+INTEGER_FIELDS = [name for name, field in SensorDataModel.model_fields.items() if field.annotation is int]
+CHUNK_ROWS = 50000
+MEASUREMENTS = {"snifferbuddy"}
+PIVOT_HINT = '|> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")'
+
+
+class SensorBatch:
+    """One chunk of validated readings as numpy columns.  Rows that failed validation have already been dropped."""
+    def __init__(self, timestamps: np.ndarray, locations: np.ndarray, names: np.ndarray, fields: Dict[str, np.ndarray], rejected: int):
+        self.timestamps = timestamps
+        self.locations = locations
+        self.names = names
+        self.fields = fields
+        self.rejected = rejected
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+
+def _to_float(values: List[str]) -> np.ndarray:
+    """Convert a column of strings to floats.  Blank or unparseable entries become NaN."""
+    column = np.array(values, dtype=str)
+    column = np.where(column == "", "nan", column)
+    try:
+        return column.astype(float)
+    except ValueError:
+        # Something in the chunk is not a number.  Fall back to converting one at a time for this chunk only.
+        return np.array([_parse_float(value) for value in values], dtype=float)
+
+
+def _parse_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _parse_time(value: str) -> int:
+    """An RFC 3339 time in whole seconds, or 0 (which validation rejects) if it can't be parsed."""
+    try:
+        return int(np.datetime64(value, "s").astype(np.int64))
+    except ValueError:
+        return 0
+
+
+def _to_seconds(timestamps: np.ndarray) -> np.ndarray:
+    """telegraf writes seconds, milliseconds, microseconds or nanoseconds depending on its precision setting."""
+    timestamps = timestamps.astype(np.int64)
+    return np.select(
+        [timestamps >= 10**17, timestamps >= 10**14, timestamps >= 10**11],
+        [timestamps // 10**9, timestamps // 10**6, timestamps // 10**3],
+        timestamps,
+    )
+
+
+def validate(timestamps: np.ndarray, locations: np.ndarray, names: np.ndarray, fields: Dict[str, np.ndarray]) -> SensorBatch:
+    """
+    Apply SensorDataModel's rules to whole columns:  every field must be present and a finite number, and integer
+    fields (light) must hold whole numbers.
+
+    Returns:
+        SensorBatch: The rows that passed.
+    """
+    valid = timestamps > 0
+    for name in FIELDS:
+        valid &= np.isfinite(fields[name])
+    for name in INTEGER_FIELDS:
+        valid &= np.mod(np.nan_to_num(fields[name]), 1) == 0
+    valid &= locations != ""
+    checked = {name: (values[valid].astype(np.int64) if name in INTEGER_FIELDS else values[valid]) for name, values in fields.items()}
+    return SensorBatch(timestamps[valid], locations[valid], names[valid], checked, int(len(valid) - valid.sum()))
+
+
+def read_influx_csv(path: str, chunk_rows: int = CHUNK_ROWS) -> Iterator[SensorBatch]:
+    """
+    Read an annotated CSV export from InfluxDB in chunks.
+
+    The export needs one row per reading, i.e. the Flux query has to pivot the fields into columns:
+        from(bucket: "snifferbuddy") |> range(...) |> filter(fn: (r) => r._measurement == "snifferbuddy")
+            |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+    An unpivoted export has one row per field, and putting those back together would mean holding the whole file.
+    """
+    with open(path, newline="", encoding="utf-8") as file:
+        reader = csv.reader(file)
+        header: Optional[List[str]] = None
+        while True:
+            rows = list(islice(reader, chunk_rows))
+            if not rows:
+                return
+            # A new table (after a blank line) repeats the annotations and the header, so the chunk is split on headers.
+            data_rows: List[List[str]] = []
+            for row in rows:
+                if not row or not any(row) or row[0].startswith("#"):
+                    continue
+                if "_time" in row:
+                    if data_rows and header:
+                        yield _influx_batch(header, data_rows)
+                        data_rows = []
+                    header = row
+                    if "_field" in header and "_value" in header:
+                        raise ValueError(f"{path} has one row per field.  Export it with the fields pivoted into columns: {PIVOT_HINT}")
+                    continue
+                if header is not None:
+                    data_rows.append(row)
+            if data_rows and header:
+                yield _influx_batch(header, data_rows)
+
+
+def _influx_batch(header: List[str], rows: List[List[str]]) -> SensorBatch:
+    index = {name: i for i, name in enumerate(header)}
+    width = len(header)
+    # Short rows are padded so the columns line up.
+    rows = [row if len(row) == width else (row + [""] * width)[:width] for row in rows]
+    columns = list(zip(*rows))
+    times = np.array(columns[index["_time"]], dtype=str)
+    times = np.char.rstrip(times, "Z")
+    try:
+        timestamps = np.array(times, dtype="datetime64[ns]").astype("datetime64[s]").astype(np.int64)
+    except ValueError:
+        # A malformed time somewhere in the chunk.  Parse this chunk one at a time so only that row is rejected.
+        timestamps = np.array([_parse_time(value) for value in times], dtype=np.int64)
+    empty = np.full(len(rows), "", dtype=object)
+    locations = np.array(columns[index["location"]], dtype=object) if "location" in index else empty
+    names = np.array(columns[index["name"]], dtype=object) if "name" in index else empty
+    nan = np.full(len(rows), math.nan)
+    fields = {name: (_to_float(columns[index[name]]) if name in index else nan) for name in FIELDS}
+    return validate(timestamps, locations, names, fields)
+
+
+def read_telegraf_log(path: str, chunk_rows: int = CHUNK_ROWS, measurements=MEASUREMENTS) -> Iterator[SensorBatch]:
+    """
+    Read a telegraf stdout log in chunks.  Lines can be telegraf's JSON output format or influx line protocol.  Lines
+    that are neither (telegraf's own log messages) and other measurements are skipped.
+    """
+    with open(path, encoding="utf-8", errors="replace") as file:
+        while True:
+            lines = list(islice(file, chunk_rows))
+            if not lines:
+                return
+            timestamps: List[int] = []
+            locations: List[str] = []
+            names: List[str] = []
+            fields: Dict[str, List[float]] = {name: [] for name in FIELDS}
+            for line in lines:
+                parsed = _parse_json_line(line) if line.startswith("{") else _parse_line_protocol(line)
+                if parsed is None or parsed[0] not in measurements:
+                    continue
+                _, tags, values, timestamp = parsed
+                timestamps.append(timestamp)
+                locations.append(tags.get("location", ""))
+                names.append(tags.get("name", ""))
+                for name in FIELDS:
+                    fields[name].append(_parse_float(values.get(name)))
+            if timestamps:
+                yield validate(
+                    _to_seconds(np.array(timestamps, dtype=np.int64)),
+                    np.array(locations, dtype=object),
+                    np.array(names, dtype=object),
+                    {name: np.array(values, dtype=float) for name, values in fields.items()},
+                )
+
+
+def _parse_json_line(line: str):
+    try:
+        metric = loads(line)
+        return metric["name"], metric.get("tags", {}), metric["fields"], int(metric["timestamp"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def _parse_line_protocol(line: str):
+    # measurement,tag=value,tag=value field=value,field=value timestamp
+    # Escaped spaces and commas are not used in SnifferBuddy tags or field names, so a plain split is enough.
+    parts = line.strip().split(" ")
+    if len(parts) != 3:
+        return None
+    series, field_set, timestamp = parts
+    measurement, *tag_pairs = series.split(",")
+    try:
+        tags = dict(pair.split("=", 1) for pair in tag_pairs)
+        values = {}
+        for pair in field_set.split(","):
+            key, value = pair.split("=", 1)
+            # Integer fields carry an 'i' suffix.
+            values[key] = value[:-1] if value.endswith("i") else value
+        return measurement, tags, values, int(timestamp)
+    except ValueError:
+        return None
+
+
+def read_backfill(path: str, chunk_rows: int = CHUNK_ROWS) -> Iterator[SensorBatch]:
+    """Pick the reader from the file:  annotated CSV starts with '#' annotations or a header with _time in it."""
+    with open(path, encoding="utf-8", errors="replace") as file:
+        first_line = file.readline()
+    if first_line.startswith("#") or "_time" in first_line:
+        return read_influx_csv(path, chunk_rows)
+    return read_telegraf_log(path, chunk_rows)
+
+
+RUN_DTYPE = np.dtype([(name, dtype) for name, dtype in COLUMNS.items()])
+
+
+class TentRuns:
+    """
+    The validated rows of one tent, spooled to files under `directory`.  Each file is a run of rows in timestamp order.
+    A new run starts whenever a chunk goes back in time, e.g. where the export moves on to the next sensor's series.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.paths: List[str] = []
+        self._last_timestamp: Optional[int] = None
+
+    def add(self, columns: Dict[str, np.ndarray]):
+        records = np.empty(len(columns["timestamp"]), dtype=RUN_DTYPE)
+        for name in COLUMNS:
+            records[name] = columns[name]
+        records = records[np.argsort(records["timestamp"], kind="stable")]
+        if self._last_timestamp is None or records["timestamp"][0] < self._last_timestamp:
+            self.paths.append(os.path.join(self.directory, f"{len(self.paths)}.run"))
+        with open(self.paths[-1], "ab") as file:
+            records.tofile(file)
+        self._last_timestamp = int(records["timestamp"][-1])
+
+    def merged(self, chunk_rows: int = CHUNK_ROWS) -> Iterator[Dict[str, np.ndarray]]:
+        """
+        Merge the runs into batches in timestamp order.  Each round takes every row up to the time where the first run
+        to get there has given chunk_rows rows, so rows with the same timestamp always come out in the same batch.
+        """
+        runs = [np.memmap(path, dtype=RUN_DTYPE, mode="r") for path in self.paths]
+        positions = [0] * len(runs)
+        while True:
+            live = [i for i, run in enumerate(runs) if positions[i] < len(run)]
+            if not live:
+                return
+            cutoff = min(runs[i]["timestamp"][min(positions[i] + chunk_rows, len(runs[i])) - 1] for i in live)
+            pieces = []
+            for i in live:
+                end = int(np.searchsorted(runs[i]["timestamp"], cutoff, side="right"))
+                pieces.append(runs[i][positions[i]:end])
+                positions[i] = end
+            records = np.concatenate(pieces)
+            records = records[np.argsort(records["timestamp"], kind="stable")]
+            yield {name: records[name] for name in COLUMNS}
+
+
+def import_into_history(path: str, directory: str, chunk_rows: int = CHUNK_ROWS) -> Dict[str, int]:
+    """
+    Stream a backfill file into the per-tent SensorHistoryStores under directory.
+
+    Returns:
+        dict: Counts of rows read, rows imported, rows rejected by validation and rows dropped by the store because
+            they were not newer than what it already held.
+    """
+    logger = LoggerBase.setup_logger('Backfill')
+    counts = {"read": 0, "imported": 0, "rejected": 0, "dropped": 0}
+    # The runs are spooled next to the history so they are on the same disk, and removed afterwards.
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix=".backfill-", dir=directory) as spool:
+        tents: Dict[str, TentRuns] = {}
+        for batch in read_backfill(path, chunk_rows):
+            counts["read"] += len(batch) + batch.rejected
+            counts["rejected"] += batch.rejected
+            for location in np.unique(batch.locations):
+                rows = batch.locations == location
+                if location not in tents:
+                    tents[location] = TentRuns(tempfile.mkdtemp(dir=spool))
+                columns = {"timestamp": batch.timestamps[rows]}
+                columns.update({name: values[rows] for name, values in batch.fields.items()})
+                tents[location].add(columns)
+        for location, runs in tents.items():
+            store = SensorHistoryStore.open(location, directory)
+            for columns in runs.merged(chunk_rows):
+                added = store.append_batch(columns)
+                counts["imported"] += added
+                counts["dropped"] += len(columns["timestamp"]) - added
+            store.flush()
+    logger.debug(f"Imported {path}: {counts}")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import historical SnifferBuddy readings from an InfluxDB CSV export or a telegraf log.")
+    parser.add_argument("path")
+    parser.add_argument("--history-dir", help="Import into the sensor history stores in this directory.  Without it the file is only parsed and validated.")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    args = parser.parse_args()
+    started = time.perf_counter()
+    if args.history_dir:
+        counts = import_into_history(args.path, args.history_dir, args.chunk_rows)
+    else:
+        counts = {"read": 0, "imported": 0, "rejected": 0}
+        for batch in read_backfill(args.path, args.chunk_rows):
+            counts["read"] += len(batch) + batch.rejected
+            counts["rejected"] += batch.rejected
+    seconds = time.perf_counter() - started
+    print(f"{counts} in {seconds:.1f} s ({60 * counts['read'] / seconds:,.0f} rows/minute)")
+
+
+if __name__ == "__main__":
+    main()
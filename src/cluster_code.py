@@ -0,0 +1,298 @@
+import asyncio
+import hashlib
+from json import dumps, loads
+import time
+from typing import Callable, Coroutine, Dict, Iterable, List, Optional, Tuple
+
+from logger_code import LoggerBase
+from mqtt_code import new_mqtt_client
+from pydantic_models import GlobalConfig, GrowTentParams
+
+CLUSTER_PREFIX = "growbuddies/cluster"
+NODES_TOPIC = f"{CLUSTER_PREFIX}/nodes"
+STATE_TOPIC = f"{CLUSTER_PREFIX}/state"
+
+
+def assign_tents(tents: Iterable[str], nodes: Iterable[str]) -> Dict[str, str]:
+    """
+    Decide which node owns each tent with rendezvous hashing:  each tent goes to the node with the highest hash of
+    (tent, node).  Every node gets the same answer from the same membership without having to talk it over, and when a
+    node joins or leaves only the tents it gains or loses move.
+
+    Returns:
+        dict: Tent name to node id.  Empty if there are no nodes.
+    """
+    nodes = list(nodes)
+    if not nodes:
+        return {}
+
+    def score(tent: str, node: str) -> bytes:
+        # hashlib rather than hash() since hash() of a str is different in every Python process.
+        return hashlib.sha1(f"{tent}|{node}".encode("utf-8")).digest()
+
+    return {tent: max(nodes, key=lambda node: score(tent, node)) for tent in tents}
+
+
+class ClusterNode:
+    """
+    Coordinates the GrowBuddies nodes that share a broker.  Each node publishes a retained heartbeat on
+    growbuddies/cluster/nodes/<node_id> and watches everyone else's.  The tents are shared out with assign_tents() over
+    the nodes that are alive, and on_acquire/on_release are called as this node gains and loses tents.
+
+    A node leaving cleanly clears its heartbeat.  If it dies, the broker publishes its last will, which clears it too,
+    and a node whose heartbeats just stop is dropped after `node_timeout` seconds.  Either way the other nodes pick up its
+    tents within seconds.
+
+    Learned PID gains and Q-tables are shared as retained messages on growbuddies/cluster/state/<tent>/<controller>, so
+    the node that takes over a tent starts from where the last owner left off.
+    """
+    def __init__(self, node_id: str, tents: List[str], client=None, hostname: str = "gus.local", port: int = 1883,
+                 heartbeat_seconds: float = 2, node_timeout: float = 6,
+                 on_acquire: Optional[Callable[[str], Coroutine]] = None, on_release: Optional[Callable[[str], Coroutine]] = None):
+        self.logger = LoggerBase.setup_logger('ClusterNode')
+        self.node_id = node_id
+        self.tents = list(tents)
+        # Anything with paho's Client interface works.  Tests pass in a LocalBroker client.
+        self.client = client if client is not None else new_mqtt_client(node_id)
+        self.hostname = hostname
+        self.port = port
+        self.heartbeat_seconds = heartbeat_seconds
+        self.node_timeout = node_timeout
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.loop = None
+        # When each node was last heard from, on our own clock so clock skew between Pis doesn't matter.
+        self.last_seen: Dict[str, float] = {}
+        self.owned: set = set()
+        self.shared_state: Dict[Tuple[str, str], dict] = {}
+        self._heartbeat_task = None
+        self._tasks = set()
+        # False until the first heartbeat interval is over.  Until then the other nodes' retained heartbeats are still
+        # coming in, and rebalancing on a partial view would grab tents only to hand them straight back.
+        self._settled = False
+
+    @property
+    def node_topic(self) -> str:
+        return f"{NODES_TOPIC}/{self.node_id}"
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        # If we go away without saying so, the broker clears our heartbeat for us.
+        self.client.will_set(self.node_topic, payload=None, qos=1, retain=True)
+        self.client.on_message = self._on_message
+        self.client.connect(self.hostname, self.port)
+        self.client.subscribe(f"{NODES_TOPIC}/+", qos=1)
+        self.client.subscribe(f"{STATE_TOPIC}/+/+", qos=1)
+        self.client.loop_start()
+        self._heartbeat_task = self.loop.create_task(self._heartbeat())
+        self.logger.debug(f"Node {self.node_id} joined the cluster.")
+
+    async def stop(self):
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+        for tent in sorted(self.owned):
+            await self._call(self.on_release, tent)
+        self.owned.clear()
+        # Clear our retained heartbeat so the other nodes take our tents right away.
+        self.client.publish(self.node_topic, payload=None, qos=1, retain=True)
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def owns(self, tent: str) -> bool:
+        return tent in self.owned
+
+    def live_nodes(self) -> List[str]:
+        now = self.loop.time()
+        return sorted({self.node_id} | {node for node, seen in self.last_seen.items() if now - seen <= self.node_timeout})
+
+    def publish_state(self, tent: str, controller_type: str, Kp: float, Ki: float, Kd: float, q_table=None):
+        """Share the latest gains (and Q-table, e.g. a numpy array) of a controller this node runs."""
+        state = {"node_id": self.node_id, "time": time.time(), "Kp": Kp, "Ki": Ki, "Kd": Kd}
+        if q_table is not None:
+            state["q_table"] = q_table.tolist() if hasattr(q_table, "tolist") else q_table
+        self.shared_state[(tent, controller_type.upper())] = state
+        self.client.publish(f"{STATE_TOPIC}/{tent}/{controller_type.upper()}", dumps(state), qos=1, retain=True)
+
+    def get_state(self, tent: str, controller_type: str) -> Optional[dict]:
+        return self.shared_state.get((tent, controller_type.upper()))
+
+    async def _heartbeat(self):
+        self._beat()
+        await asyncio.sleep(self.heartbeat_seconds)
+        self._settled = True
+        while True:
+            await self.rebalance()
+            await asyncio.sleep(self.heartbeat_seconds)
+            self._beat()
+
+    def _beat(self):
+        self.client.publish(self.node_topic, dumps({"node_id": self.node_id, "time": time.time()}), qos=1, retain=True)
+
+    def _on_message(self, client, userdata, message):
+        # paho calls this on its network thread.  The work is done on the event loop.
+        self.loop.call_soon_threadsafe(self._handle, message.topic, message.payload)
+
+    def _handle(self, topic: str, payload: bytes):
+        parts = topic.split("/")
+        if topic.startswith(NODES_TOPIC) and len(parts) == 4:
+            node = parts[3]
+            if node == self.node_id:
+                return
+            if payload:
+                joined = node not in self.last_seen
+                self.last_seen[node] = self.loop.time()
+                if joined:
+                    self.logger.debug(f"Node {node} joined.")
+                    if self._settled:
+                        self._spawn(self.rebalance())
+            elif self.last_seen.pop(node, None) is not None:
+                self.logger.debug(f"Node {node} left.")
+                if self._settled:
+                    self._spawn(self.rebalance())
+        elif topic.startswith(STATE_TOPIC) and len(parts) == 5 and payload:
+            try:
+                state = loads(payload)
+            except ValueError:
+                self.logger.error(f"Could not read the shared state on {topic}.")
+                return
+            if state.get("node_id") != self.node_id:
+                self.shared_state[(parts[3], parts[4])] = state
+
+    async def rebalance(self):
+        """Work out the tents this node should own from the live nodes and acquire/release the difference."""
+        assignment = assign_tents(self.tents, self.live_nodes())
+        wanted = {tent for tent, node in assignment.items() if node == self.node_id}
+        for tent in sorted(self.owned - wanted):
+            self.owned.discard(tent)
+            self.logger.debug(f"Node {self.node_id} releases {tent}.")
+            await self._call(self.on_release, tent)
+        for tent in sorted(wanted - self.owned):
+            self.owned.add(tent)
+            self.logger.debug(f"Node {self.node_id} takes over {tent}.")
+            await self._call(self.on_acquire, tent)
+
+    async def _call(self, callback, tent: str):
+        if callback:
+            try:
+                await callback(tent)
+            except Exception as e:
+                self.logger.error(f"Error handing over {tent}: {e}")
+
+    def _spawn(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+def log_task_failure(logger, what: str):
+    """A done-callback that logs the exception a task ended with, since nothing else awaits it."""
+    def done(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"{what} stopped: {task.exception()!r}")
+    return done
+
+
+class TentSupervisor:
+    """
+    Runs GrowTentEnvs for the tents a ClusterNode owns.  On taking over a tent it loads the gains the last owner shared
+    into the tent's PID config, gives each environment an agent with the shared Q-table and starts them.  While it
+    owns a tent it shares the gains, and the Q-table of any environment with an agent, every `share_seconds` and once
+    more when it lets the tent go.
+
+    Only one socket can be bound to the SnifferBuddy port, so the supervisor listens on it once for the whole node and
+    hands each reading to the environments of the tent it came from.  Environments set to "udp" ingest are started
+    with "none" instead.  The listener is opened with the first tent and closed with the last.
+    """
+    def __init__(self, node: ClusterNode, params_for_tent: Callable[[str], List[GrowTentParams]], share_seconds: float = 60,
+                 port: int = 8095):
+        # Imported here so the cluster logic can be used without gym and the rest of the environment's dependencies.
+        from growtent_env_code import GrowTentEnv
+        from process_udp_code import UDPProcessor
+        from q_agent_code import QLearningAgent
+        self._env_class = GrowTentEnv
+        self._agent_class = QLearningAgent
+        self.logger = LoggerBase.setup_logger('TentSupervisor')
+        self.node = node
+        self.params_for_tent = params_for_tent
+        self.share_seconds = share_seconds
+        self.port = port
+        self.running: Dict[str, List[tuple]] = {}
+        self.listener = UDPProcessor(self.logger)
+        node.on_acquire = self.acquire
+        node.on_release = self.release
+
+    async def acquire(self, tent: str):
+        loop = asyncio.get_running_loop()
+        if self.listener.transport is None:
+            await self.listener.init_udp_listener(self._fan_out, self.port)
+        runs = []
+        for params in self.params_for_tent(tent):
+            state = self.node.get_state(tent, params.controller_type)
+            if state:
+                pid_config = GlobalConfig.get_pid_config(tent, params.controller_type)
+                pid_config.Kp, pid_config.Ki, pid_config.Kd = state["Kp"], state["Ki"], state["Kd"]
+                self.logger.debug(f"Starting {tent} {params.controller_type} with the gains {state['node_id']} shared.")
+            if params.ingest == "udp":
+                params = params.model_copy(update={"ingest": "none"})
+            env = self._env_class(params, None)
+            if state and state.get("q_table") is not None:
+                env.agent = self._agent_class(env.logger, q_table=state["q_table"])
+            start_task, share_task = loop.create_task(env.start()), loop.create_task(self._share(env))
+            start_task.add_done_callback(log_task_failure(self.logger, f"{tent} {params.controller_type}"))
+            share_task.add_done_callback(log_task_failure(self.logger, f"Sharing the gains of {tent} {params.controller_type}"))
+            runs.append((env, start_task, share_task))
+        self.running[tent] = runs
+
+    async def release(self, tent: str):
+        for env, start_task, share_task in self.running.pop(tent, []):
+            start_task.cancel()
+            share_task.cancel()
+            self._share_once(env)
+            # start() closes the environment on its way out too, but not if it was cancelled before it got going.
+            await env.close()
+        if not self.running:
+            self.listener.close()
+
+    async def _fan_out(self, reading):
+        for env, _, _ in self.running.get(reading.tags.get("location"), []):
+            if env.ingest == "none":
+                await env.receive_sensor_reading_callback(reading)
+
+    async def _share(self, env):
+        while True:
+            await asyncio.sleep(self.share_seconds)
+            self._share_once(env)
+
+    def _share_once(self, env):
+        if env.pid:
+            q_table = env.agent.q_table if env.agent is not None else None
+            self.node.publish_state(env.tent_name, env.controller_type, env.pid.Kp, env.pid.Ki, env.pid.Kd, q_table)
+
+
+async def demo(tents: int = 6, heartbeat_seconds: float = 0.5, node_timeout: float = 1.5):
+    """Run three nodes on a LocalBroker, then drop one without warning and time how long its tents take to move."""
+    from local_broker_code import LocalBroker
+
+    broker = LocalBroker()
+    tent_names = [f"tent_{i + 1}" for i in range(tents)]
+    nodes = [ClusterNode(f"node_{n}", tent_names, broker.client(f"node_{n}"), heartbeat_seconds=heartbeat_seconds, node_timeout=node_timeout) for n in "abc"]
+    for node in nodes:
+        await node.start()
+    await asyncio.sleep(heartbeat_seconds * 2)
+    for node in nodes:
+        print(f"{node.node_id} owns {sorted(node.owned)}")
+    # Drop node_c as if its Pi lost power.  The broker publishes its last will.
+    orphaned = set(nodes[2].owned)
+    nodes[2]._heartbeat_task.cancel()
+    nodes[2].client.drop()
+    started = time.perf_counter()
+    while not orphaned <= (nodes[0].owned | nodes[1].owned):
+        await asyncio.sleep(0.01)
+    print(f"{sorted(orphaned)} moved to the other nodes in {1000 * (time.perf_counter() - started):.0f} ms")
+    for node in nodes[:2]:
+        print(f"{node.node_id} owns {sorted(node.owned)}")
+        await node.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(demo())
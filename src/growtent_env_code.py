@@ -1,22 +1,28 @@
-from json import loads
-
 import asyncio
-
-from scipy.signal import find_peaks
-
+import time
+from typing import Optional
 
 import gym
 from gym import spaces
-import numpy as np
 
 
 
+from actuation_scheduler_code import ActuationScheduler
+from jitter_buffer_code import JitterBufferStage
 from logger_code import LoggerBase
 from mqtt_code import async_publish_single
+from mqtt_ingest_code import SnifferBuddyMQTTIngest
+from offline_q_training_code import GAIN_STEPS, PIDStateRecorder
 from process_udp_code import UDPProcessor
 from pid_code import PID_Controller
-from pydantic_models import GlobalConfig, GrowTentParams, SnifferBuddy, PIDState, MonitorParam
+from pydantic_models import GlobalConfig, GrowTentParams, SnifferBuddyModel, PIDState, MonitorParam
 from q_agent_code import QLearningAgent
+from sensor_fusion_code import SensorFusion
+from sensor_history_code import SensorHistoryStore
+from step_metrics_code import SETTLE_BANDS, StepResponseMetrics
+from telemetry_rate_code import TelemetryRateController
+from trace_code import Tracer
+from wire_format_code import DecodedReading, SnifferBuddyReading
 
 
 CONFIG_FILENAME = 'config/growbuddies_config.json'
@@ -39,6 +45,7 @@ class GrowTentEnv(gym.Env):
         self.controller_type = params.controller_type
         self.sensor_reading_callback = params.sensor_reading_callback
         self.PID_state_callback = params.PID_state_callback
+        self.ingest = params.ingest
         pid_config = GlobalConfig.get_pid_config(self.tent_name, self.controller_type)
         self.hostname = pid_config.hostname
         self.snifferbuddy_incoming_port = pid_config.snifferbuddy_incoming_port
@@ -54,47 +61,97 @@ class GrowTentEnv(gym.Env):
 
         self.state = None  # Placeholder for the environment state
         self.pid = None
+        # The QLearningAgent choosing this environment's actions, set by whoever drives step().  TentSupervisor shares
+        # its Q-table with the other nodes.
+        self.agent: Optional[QLearningAgent] = None
+        # How MQTT messages go out.  The soak test swaps in a stand-in so it can run the full loop without a broker.
+        self.publish = async_publish_single
+        # The clock the PID times readings without a timestamp on.  The simulation swaps in its virtual clock.
+        self.clock = time.monotonic
+        self.actuation_scheduler = ActuationScheduler.shared() if params.use_actuation_scheduler else None
+        self.telemetry_rate = TelemetryRateController.shared(self.hostname) if params.adaptive_telemetry else None
+        self.tuning_done = False
         self.received_event = asyncio.Event()  # Event to signal that a message has been received.
-        self.sensor_values = [] # Used to determine when to stop Kp tuning.
-
-    async def receive_sensor_reading_callback(self, reading) -> None:
+        self.step_metrics = None # Used to determine when each tuning phase is done.
+        # Duplicate and out of order readings are sorted out before they get to the PID.
+        self.jitter_buffer = JitterBufferStage(self.handle_pid, params.jitter_hold_seconds)
+        self.history = SensorHistoryStore.open(self.tent_name, params.history_dir) if params.history_dir else None
+        self.pid_recorder = PIDStateRecorder(params.pid_trace_path) if params.pid_trace_path else None
+        self.listener = None
+        # With more than one SnifferBuddy in the tent, the PID gets one fused reading per tick instead of each sensor's in turn.
+        self.sensor_fusion = SensorFusion(self.tent_name, params.fusion_tick_seconds, params.fusion_stale_seconds) if params.fuse_sensors else None
+
+    async def receive_sensor_reading_callback(self, reading: SnifferBuddyReading) -> None:
         self.received_event.set()
         self.logger.debug(f"Received reading: {reading}")
         if self.sensor_reading_callback:
             self.logger.debug("there is a sensor reading callback...")
-            await self.sensor_reading_callback(reading)  # Awaiting the async callback
-        await self.handle_pid(reading)
+            # Callbacks from outside are promised a SnifferBuddyModel.
+            model = reading.to_model() if isinstance(reading, DecodedReading) else reading
+            await self.sensor_reading_callback(model)  # Awaiting the async callback
+        await self.jitter_buffer(reading)
 
-    async def handle_pid(self, reading):
-        # Transform the reading into a more accessible format
-        incoming_data = loads(reading)
-        snifferbuddy_data = SnifferBuddy(**incoming_data)
+    async def handle_pid(self, snifferbuddy_data: SnifferBuddyReading):
+        with Tracer.span("handle_pid", tent=self.tent_name, controller=self.controller_type):
+            await self._handle_pid(snifferbuddy_data)
+
+    async def _handle_pid(self, snifferbuddy_data: SnifferBuddyReading):
         # Check if the reading came from the grow tent we are interested in.
         if snifferbuddy_data.tags['location'] == self.tent_name:
-            # Check if the light is off.  If it is off, don't do anything.
-            print(f"light: {snifferbuddy_data.fields.light}")
-            if snifferbuddy_data.fields.light == 1: # The light is on
-                # Figure out what value is being controlled.
-                value = None
-                if self.controller_type.upper() == "CO2":
-                    value = snifferbuddy_data.fields.CO2
-                elif self.controller_type.upper() == "VPD":
-                    value = snifferbuddy_data.fields.vpd
-                if value:
-                    self.sensor_values.append(value)
-                # TODO: Decide if to delay by say 1/2 in the morning to let the plant wake up?
-
-                # Send to the PID controller
-                seconds_on = 0
-                if value:
-                    self.logger.debug(f"Sending value {value} to the {self.controller_type} PID controller")
-                    seconds_on = self.pid(value)
-                    if seconds_on > 0.0:
-                        # Tell the power plugs to turn on but turn off after seconds_on.
-                        self.logger.debug(f"Turning on the {self.controller_type} for {seconds_on} seconds.")
-                        await self.turn_on_power(seconds_on, self.mqtt_power_topics)
-                else:
-                    self.logger.warning(f"Did not receive a value for {self.tent_name}, {self.controller_type}")
+            if self.history:
+                self.history.append_reading(snifferbuddy_data)
+            reading = self.sensor_fusion.update(snifferbuddy_data) if self.sensor_fusion else snifferbuddy_data
+            if reading is not None:
+                await self._control(reading)
+            # The rate is set per SnifferBuddy, so it goes by the sensor's own reading rather than the fused one.
+            await self._adjust_telemetry_rate(snifferbuddy_data)
+
+    async def _control(self, snifferbuddy_data: SnifferBuddyModel):
+        # Check if the light is off.  If it is off, don't do anything.
+        self.logger.debug(f"light: {snifferbuddy_data.fields.light}")
+        if snifferbuddy_data.fields.light == 1: # The light is on
+            # Figure out what value is being controlled.
+            value = None
+            if self.controller_type.upper() == "CO2":
+                value = snifferbuddy_data.fields.CO2
+            elif self.controller_type.upper() == "VPD":
+                value = snifferbuddy_data.fields.vpd
+            if value:
+                self.step_metrics.update(value, snifferbuddy_data.timestamp)
+                self.check_if_done()
+            # TODO: Decide if to delay by say 1/2 in the morning to let the plant wake up?
+
+            # Send to the PID controller
+            seconds_on = 0
+            if value:
+                self.logger.debug(f"Sending value {value} to the {self.controller_type} PID controller")
+                # The PID works out dt from the SnifferBuddy's timestamp rather than when the reading got here.
+                seconds_on = self.pid(value, snifferbuddy_data.timestamp)
+                if seconds_on > 0.0:
+                    # Tell the power plugs to turn on but turn off after seconds_on.
+                    self.logger.debug(f"Turning on the {self.controller_type} for {seconds_on} seconds.")
+                    await self.turn_on_power(seconds_on, self.mqtt_power_topics)
+            else:
+                self.logger.warning(f"Did not receive a value for {self.tent_name}, {self.controller_type}")
+        elif self.step_metrics.samples:
+            # The controller rests while the light is off.  Tomorrow's response is measured from scratch.
+            self.step_metrics.reset()
+
+    async def _adjust_telemetry_rate(self, snifferbuddy_data: SnifferBuddyModel):
+        # Ask the SnifferBuddy for readings more often while tuning or far from the setpoint, less often when the tent is settled.
+        if not self.telemetry_rate:
+            return
+        error = 0.0
+        tuning = False
+        if snifferbuddy_data.fields.light == 1:
+            value = snifferbuddy_data.fields.CO2 if self.controller_type.upper() == "CO2" else snifferbuddy_data.fields.vpd
+            error = self.pid.config.setpoint - value
+            # Stays fast until the step response shows the current tuning phase is done.  _control keeps tuning_done up to date.
+            tuning = not self.tuning_done
+        command = self.telemetry_rate.update(snifferbuddy_data, self.controller_type, error, tuning)
+        if command:
+            self.logger.debug(f"Setting {command[0]} to {command[1]} seconds.")
+            await self._send_commands([[command]])
 
     async def turn_on_power(self,seconds_on: float, mqtt_topics: list):
         """
@@ -103,12 +160,14 @@ class GrowTentEnv(gym.Env):
         Args:
             power_state (int): Desired power state, either 1 (for on) or 0.
         """
+        with Tracer.span("turn_on_power", seconds_on=seconds_on):
+            await self._turn_on_power(seconds_on, mqtt_topics)
 
+    async def _turn_on_power(self, seconds_on: float, mqtt_topics: list):
+        commands = []
         for power_topic in mqtt_topics:
             self.logger.debug(f"POWER TOPIC: {power_topic}")
             pulsetime_value = 0.0
-            # Sending a 1 to the mqtt topic that the tasmota switch is listening to turns the switch on.
-            await async_publish_single(self.hostname, power_topic, 1, self.logger)
             # Immediately after turning on the switch, the "PulseTime" Tasmota command is given with the number of seconds to keep the switch on.  Once this number is exceeded, the switch is turned off.
             # Tasmota's PulseTime command handles two ranges:
                 ## Quick Timer Range (0.1 - 11.1 seconds): Direct mapping with each unit representing 0.1 seconds.
@@ -127,91 +186,109 @@ class GrowTentEnv(gym.Env):
             # Join the parts back together to form the new topic
             pulsetime_topic = "/".join(parts)
 
-            await async_publish_single(self.hostname, pulsetime_topic, pulsetime_value, self.logger)
+            # Sending a 1 to the mqtt topic that the tasmota switch is listening to turns the switch on.  PulseTime follows right after it.
+            commands.append([(power_topic, 1), (pulsetime_topic, pulsetime_value)])
             self.logger.debug(
                 f"PulseTime {pulsetime_topic} is set to {pulsetime_value} to turn off after {seconds_on} seconds."
             )
+        await self._send_commands(commands)
+
+    async def _send_commands(self, commands: list):
+        """Publish lists of (topic, payload) messages.  Each list goes to one device, in order."""
+        if self.actuation_scheduler:
+            # The scheduler spreads the publishes out so the plugs and the broker don't get hit by bursts from many tents.
+            # It logs failed publishes itself, so the reading that asked for them doesn't wait on the rate limits.
+            for messages in commands:
+                self.actuation_scheduler.submit(self.hostname, messages, self.logger, self.publish)
+        else:
+            for messages in commands:
+                for topic, payload in messages:
+                    await self.publish(self.hostname, topic, payload, self.logger)
 
-    async def receive_PID_state_callback(self, PID_state:PIDState):
+    async def receive_PID_state_callback(self, PID_state:PIDState, timestamp: Optional[int] = None):
         self.logger.debug(f"Received the PID state of: {PID_state.model_dump_json(indent=4)}")
+        if self.pid_recorder:
+            self.pid_recorder.record(PID_state, self.tent_name, self.controller_type, self.pid.config.setpoint, timestamp)
         if self.PID_state_callback:
             loop = asyncio.get_running_loop()
             loop.create_task(self.PID_state_callback(PID_state))
 
 
-    async def start(self):
-
+    def init_pid(self):
         # We need the PID configuration info.
         pid_config = GlobalConfig.get_pid_config(self.tent_name, self.controller_type.lower())
         self.logger.debug(f"PID config: {pid_config}")
         # We need to start the PID controller.  When we start, we give it a callback to get a pid_values_dict.
-        self.pid = PID_Controller(self.tent_name, self.controller_type, pid_config, self.receive_PID_state_callback)
+        self.pid = PID_Controller(self.tent_name, self.controller_type, pid_config, self.receive_PID_state_callback, self.clock)
+        self.step_metrics = StepResponseMetrics(pid_config.setpoint, SETTLE_BANDS[self.controller_type.upper()])
         self.logger.debug(f"Initialized PID controller for tent {self.tent_name}, {self.controller_type}")
-        # Start listening for SnifferBuddy packets.
-        snifferbuddy_incoming_port = 8095
-        await UDPProcessor(self.logger).init_udp_listener(self.receive_sensor_reading_callback,snifferbuddy_incoming_port)
-        while True:
-            await asyncio.wait_for(self.received_event.wait(), timeout=120)  # Wait for the event to be set, with a timeout
-            self.received_event.clear()
+
+    async def start(self):
+        self.init_pid()
+        try:
+            # Start listening for SnifferBuddy packets.
+            if self.ingest == "mqtt":
+                # Subscribe to the SnifferBuddy MQTT topics ourselves instead of waiting on telegraf's 30 second means.
+                self.listener = SnifferBuddyMQTTIngest(self.logger, self.receive_sensor_reading_callback, self.hostname)
+                await self.listener.start()
+            elif self.ingest == "udp":
+                snifferbuddy_incoming_port = 8095
+                self.listener = UDPProcessor(self.logger)
+                await self.listener.init_udp_listener(self.receive_sensor_reading_callback,snifferbuddy_incoming_port)
+            while True:
+                await asyncio.wait_for(self.received_event.wait(), timeout=120)  # Wait for the event to be set, with a timeout
+                self.received_event.clear()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """
+        Stop listening, hand on the readings the jitter buffer is still holding and get what has been recorded onto
+        disk.  start() calls this on the way out.
+        """
+        if isinstance(self.listener, UDPProcessor):
+            self.listener.close()
+        elif self.listener:
+            self.listener.stop()
+        self.listener = None
+        await self.jitter_buffer.close()
+        if self.history:
+            # Flushed rather than closed:  the other environment of the tent may still be writing to it.
+            self.history.flush()
+        if self.pid_recorder:
+            self.pid_recorder.close()
+            self.pid_recorder = None
 
 
     def check_if_done(self) -> bool:
         if self.monitor_param == MonitorParam.KP:
-            return self._check_kp_done()
+            done = self._check_kp_done()
         elif self.monitor_param == MonitorParam.KI:
-            return self._check_ki_done()
+            done = self._check_ki_done()
         elif self.monitor_param == MonitorParam.KD:
-            return self._check_kd_done()
+            done = self._check_kd_done()
         else:
             raise ValueError(f"Unknown tuning phase: {self.monitor_param}")
+        self.tuning_done = bool(done)
+        return done
 
+    # The step response metrics are kept up to date on every reading, so these checks are cheap however long tuning runs.
     def _check_kp_done(self):
-        return self._analyze_KP()
-
+        return self.step_metrics.kp_done()
 
     def _check_ki_done(self):
-        pass
+        return self.step_metrics.ki_done()
 
     def _check_kd_done(self):
-        pass
-
-    def _analyze_KP(self):
-        # Determine if we have enough server value readings to analyze.
-        sensor_array = np.array(self.sensor_values)
-        peaks, _ = find_peaks(sensor_array)
-        if len(peaks) < 2: # a minimum of 2 values are needed to determine if 2 consecutive peaks are within the tolerance.
-            return False
-
-        peak_amplitudes = sensor_array[peaks]
-
-        # Values have been analyzed.  Delete from the list
-        self.sensor_values = []
-        # Assess if oscillations are within tolerances for amplitude and period
-        if self._are_peaks_within_tolerance(peak_amplitudes):
-            return True
-        first_peak_in_last_analysis = peaks[-2]  # The first peak in the last pair analyzed
-        self.sensor_values = self.sensor_values[first_peak_in_last_analysis + 1:]
-        return False
-
-    def _are_peaks_within_tolerance(self,peak_amplitudes, tolerance=0.05):
-        for i in range(len(peak_amplitudes) - 1):
-            # Calculate the absolute difference between consecutive peaks
-            amplitude_diff = abs(peak_amplitudes[i+1] - peak_amplitudes[i])
-                # Use the first peak in the pair as the reference for calculating percentage difference
-            if peak_amplitudes[i] > 0:  # Prevent division by zero
-                percent_diff = amplitude_diff / peak_amplitudes[i]
-
-                if percent_diff <= tolerance:
-                    return True  # Found consecutive peaks within tolerance
-        return False
+        return self.step_metrics.kd_done()
 
     def apply_action(self, action):
         self.logger.debug(f"===> Gym's action: {action}")
-        if self.controller_type.upper() == "CO2":
-            actual_adjustment = (action - 10) * 0.1
-        else:
-            actual_adjustment = (action - 10) * 1
+        actual_adjustment = (action - 10) * GAIN_STEPS[self.controller_type.upper()]
         self.logger.debug(f"Actual adjustment: {actual_adjustment}")
+        # How the old gains responded says nothing about the new ones.
+        self.step_metrics.reset()
+        self.tuning_done = False
         if self.monitor_param == MonitorParam.KP:
             updated_Kp = self.pid.Kp + actual_adjustment
             self.pid.Kp = updated_Kp
@@ -0,0 +1,192 @@
+import asyncio
+from collections import OrderedDict
+import heapq
+import itertools
+import time
+from typing import Callable, Coroutine, Dict, List, Optional, Tuple
+
+from logger_code import LoggerBase
+from pydantic_models import SnifferBuddyModel
+from trace_code import Tracer
+from wire_format_code import SnifferBuddyReading
+
+
+class JitterBuffer:
+    """
+    Drops readings it has already seen (the same location, sensor name and timestamp) and hands readings on in
+    timestamp order.
+
+    Each reading is held for up to `hold_seconds` after it arrives so a reading that was sent earlier but arrives a
+    little later can be put in front of it.  If more than `max_readings` are waiting, the oldest go on right away.  A
+    reading that shows up after a newer one from the same sensor has already been released is dropped as late.  The
+    duplicate index only remembers the last `max_keys` keys, so memory stays bounded however long the service runs.
+    """
+    def __init__(self, hold_seconds: float = 0.5, max_readings: int = 8, max_keys: int = 1024):
+        self.hold_seconds = hold_seconds
+        self.max_readings = max_readings
+        self.max_keys = max_keys
+        self._seen: "OrderedDict[Tuple[str, str, int], None]" = OrderedDict()
+        self._heap: List[tuple] = []
+        # Breaks ties between readings with the same timestamp so they come out in arrival order.
+        self._arrivals = itertools.count()
+        # The timestamp of the newest reading released, per (location, sensor name).  One sensor running behind must
+        # not make the others' readings late.
+        self._released: Dict[Tuple[str, str], int] = {}
+        self.duplicates = 0
+        self.late = 0
+
+    @staticmethod
+    def key(reading: SnifferBuddyModel) -> Tuple[str, str, int]:
+        return (reading.tags.get("location", ""), reading.tags.get("name", ""), reading.timestamp)
+
+    def push(self, reading: SnifferBuddyModel, now: float) -> List[SnifferBuddyModel]:
+        """
+        Add a reading.
+
+        Args:
+            reading (SnifferBuddyModel): The reading that just arrived.
+            now (float): The current time in seconds, on the same clock as later calls to release().
+
+        Returns:
+            list: The readings that are ready to go on, oldest first.  Often empty.
+        """
+        key = self.key(reading)
+        if key in self._seen:
+            self.duplicates += 1
+            return []
+        self._seen[key] = None
+        if len(self._seen) > self.max_keys:
+            self._seen.popitem(last=False)
+        released = self._released.get(key[:2])
+        if released is not None and reading.timestamp < released:
+            self.late += 1
+            return []
+        heapq.heappush(self._heap, (reading.timestamp, next(self._arrivals), now + self.hold_seconds, reading))
+        return self.release(now)
+
+    def release(self, now: float) -> List[SnifferBuddyModel]:
+        """Hand on the readings whose hold time is up."""
+        ready = []
+        while self._heap and (len(self._heap) > self.max_readings or self._heap[0][2] <= now):
+            ready.append(self._pop())
+        return ready
+
+    def next_deadline(self) -> Optional[float]:
+        """When the oldest waiting reading is due to go on, or None if nothing is waiting."""
+        return self._heap[0][2] if self._heap else None
+
+    def flush(self) -> List[SnifferBuddyModel]:
+        """Release everything that is being held, e.g. on shutdown."""
+        return [self._pop() for _ in range(len(self._heap))]
+
+    def _pop(self) -> SnifferBuddyModel:
+        timestamp, _, _, reading = heapq.heappop(self._heap)
+        self._released[self.key(reading)[:2]] = timestamp
+        return reading
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+
+class JitterBufferStage:
+    """
+    Runs a JitterBuffer in front of a reading callback.  It takes the same callback UDPProcessor and
+    SnifferBuddyMQTTIngest take, and calls the wrapped callback once per unique reading, in timestamp order.  One worker
+    task makes the calls so a slow callback (e.g. one waiting on MQTT) can't let a later reading overtake an earlier one.
+
+    At most `max_queued` released readings wait for the worker.  If the callback falls further behind than that, the
+    oldest waiting reading is dropped and counted in `dropped`:  a controller is better off with the newest readings.
+    """
+    def __init__(self, callback: Callable[[SnifferBuddyReading], Coroutine], hold_seconds: float = 0.5, max_readings: int = 8, max_keys: int = 1024,
+                 max_queued: int = 64):
+        self.logger = LoggerBase.setup_logger('JitterBuffer')
+        self.callback = callback
+        self.buffer = JitterBuffer(hold_seconds, max_readings, max_keys)
+        self._ready = asyncio.Queue(maxsize=max_queued)
+        self.dropped = 0
+        self._timer = None
+        self._worker = None
+        # The trace id and arrival time of traced readings that are waiting, so the worker can carry on their traces.
+        self._traces = {}
+
+    async def __call__(self, reading: SnifferBuddyReading) -> None:
+        loop = asyncio.get_running_loop()
+        if self._worker is None:
+            # The worker handles every reading, so it must not inherit the trace of the reading that happened to start it.
+            with Tracer.activate(None):
+                self._worker = loop.create_task(self._hand_on())
+        trace_id = Tracer.current()
+        key = JitterBuffer.key(reading)
+        if trace_id is not None and key not in self._traces:
+            self._traces[key] = (trace_id, time.perf_counter_ns())
+        late, duplicates = self.buffer.late, self.buffer.duplicates
+        self._queue(self.buffer.push(reading, loop.time()))
+        if self.buffer.late != late:
+            self._traces.pop(key, None)
+        elif self.buffer.duplicates != duplicates and trace_id is not None and self._traces.get(key, (None,))[0] == trace_id:
+            # A duplicate of a reading that has already gone on.  Its trace would never be picked up.
+            self._traces.pop(key)
+        self._schedule_release(loop)
+
+    def _queue(self, readings: List[SnifferBuddyModel]):
+        for reading in readings:
+            if self._ready.full():
+                oldest = self._ready.get_nowait()
+                self._traces.pop(JitterBuffer.key(oldest), None)
+                self.dropped += 1
+                if self.dropped == 1 or self.dropped % 100 == 0:
+                    self.logger.warning(f"The reading callback is falling behind.  Dropped {self.dropped} readings so far.")
+            self._ready.put_nowait(reading)
+
+    def _schedule_release(self, loop):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        deadline = self.buffer.next_deadline()
+        if deadline is not None:
+            self._timer = loop.call_at(deadline, self._release, loop)
+
+    def _release(self, loop):
+        self._timer = None
+        self._queue(self.buffer.release(loop.time()))
+        self._schedule_release(loop)
+
+    async def close(self) -> None:
+        """
+        Stop the worker and hand on every reading that is still waiting or being held, in order, e.g. on shutdown.
+        Readings that arrive afterwards start a new worker.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        remaining = []
+        while not self._ready.empty():
+            remaining.append(self._ready.get_nowait())
+        remaining.extend(self.buffer.flush())
+        for reading in remaining:
+            await self._handle(reading)
+
+    async def _hand_on(self):
+        while True:
+            await self._handle(await self._ready.get())
+
+    async def _handle(self, reading: SnifferBuddyModel):
+        trace = self._traces.pop(JitterBuffer.key(reading), None)
+        try:
+            if trace is None:
+                await self.callback(reading)
+            else:
+                trace_id, arrived_ns = trace
+                Tracer.add_span("jitter_buffer", arrived_ns, time.perf_counter_ns(), trace_id)
+                with Tracer.activate(trace_id):
+                    await self.callback(reading)
+        except Exception as e:
+            # Keep the worker alive so one bad reading doesn't stop the readings behind it.
+            self.logger.error(f"Error handling reading {JitterBuffer.key(reading)}: {e}")
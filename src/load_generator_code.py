@@ -0,0 +1,181 @@
+"""
+Load generator for the UDP ingest path.  Hundreds of virtual SnifferBuddies send telegraf format JSON datagrams (or the
+binary format) at a set aggregate rate to a real UDPProcessor, and the generator reports the rate it reached, the
+readings that never made it through and the end-to-end latency from sendto() to the reading reaching the callback.
+
+Each virtual SnifferBuddy has its own location tag, lights on for 18 hours of its day, and CO2 and VPD that follow the
+light:  the plants draw CO2 down and the lamp warms the tent while the light is on.  The readings carry simulated
+timestamps 10 seconds apart, so (location, name, timestamp) is unique for every reading sent and is what latency is
+matched on.
+
+Example:
+    python src/load_generator_code.py --sensors 300 --rate 2000 --duration 20
+"""
+import argparse
+import asyncio
+import logging
+import math
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+from logger_code import LoggerBase
+from mqtt_ingest_code import calc_vpd
+from process_udp_code import UDPProcessor
+from pydantic_models import SensorDataModel, SnifferBuddyModel
+from wire_format_code import SnifferBuddyEncoder
+
+READING_SECONDS = 10
+LIGHT_ON_HOURS = 18
+
+
+class VirtualSnifferBuddy:
+    """One simulated SnifferBuddy.  Each call to next_reading() is its next reading, READING_SECONDS later."""
+    def __init__(self, location: str, name: str, seed: int, start_timestamp: int = 1700000000):
+        self.location = location
+        self.name = name
+        self.random = random.Random(seed)
+        # Start each sensor at a different time of day so the fleet doesn't switch its lights in step.
+        self.timestamp = start_timestamp + self.random.randrange(0, 24 * 3600, READING_SECONDS)
+        self.co2 = self.random.uniform(800, 1200)
+        self.tags = {"location": location, "name": name}
+
+    def next_reading(self) -> SnifferBuddyModel:
+        self.timestamp += READING_SECONDS
+        hour = (self.timestamp % (24 * 3600)) / 3600
+        light = 1 if hour < LIGHT_ON_HOURS else 0
+        # CO2 drifts down towards what the plants leave while the light is on and back up to room level while it's off.
+        target = 700 if light else 1300
+        self.co2 += 0.01 * (target - self.co2) + self.random.gauss(0, 10)
+        # The lamp warms the tent.  A slow swing over the day on top.
+        temperature = (27.0 if light else 21.0) + 1.5 * math.sin(2 * math.pi * hour / 24) + self.random.gauss(0, 0.2)
+        humidity = min(max((55.0 if light else 65.0) + self.random.gauss(0, 1.5), 0), 100)
+        return SnifferBuddyModel(
+            fields=SensorDataModel(
+                CO2=round(self.co2), dewpoint=round(temperature - (100 - humidity) / 5, 1), eCO2=round(self.co2),
+                humidity=round(humidity, 1), light=light, temperature=round(temperature, 1), vpd=calc_vpd(temperature, humidity),
+            ),
+            name="snifferbuddy", tags=self.tags, timestamp=self.timestamp,
+        )
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return math.nan
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class LoadGenerator:
+    def __init__(self, sensors: int = 200, rate: float = 1000, duration: float = 10, port: int = 8095, host: str = "127.0.0.1",
+                 binary: bool = False, seed: int = 0, drain_seconds: float = 1.0, tick: float = 0.005):
+        """
+        Args:
+            sensors (int): How many virtual SnifferBuddies.  Each one has its own location (tent_1, tent_2, ...).
+            rate (float): Readings per second over all the sensors together.
+            duration (float): Seconds to send for.
+            port (int): The UDP port the UDPProcessor listens on.
+            host (str): The address it listens on and the generator sends to.
+            binary (bool): Send the binary wire format instead of telegraf's JSON.
+            seed (int): Seed for the sensors' random behavior.
+            drain_seconds (float): How long to wait for stragglers after the last send.
+            tick (float): How often the sender wakes up to send what is due.
+        """
+        self.logger = LoggerBase.setup_logger('LoadGenerator')
+        self.sensors = [
+            VirtualSnifferBuddy(f"tent_{i + 1}", "sniffer_1", seed + i) for i in range(sensors)
+        ]
+        self.rate = rate
+        self.duration = duration
+        self.port = port
+        self.host = host
+        self.encoder = SnifferBuddyEncoder() if binary else None
+        self.drain_seconds = drain_seconds
+        self.tick = tick
+        # When each reading still in flight was sent.
+        self._in_flight: Dict[Tuple[str, str, int], float] = {}
+        self._latencies: List[float] = []
+        self._unexpected = 0
+
+    async def _received(self, reading: SnifferBuddyModel):
+        sent = self._in_flight.pop((reading.tags["location"], reading.tags["name"], reading.timestamp), None)
+        if sent is None:
+            self._unexpected += 1
+        else:
+            self._latencies.append(time.perf_counter() - sent)
+
+    def _datagrams(self, reading: SnifferBuddyModel) -> List[bytes]:
+        if self.encoder:
+            return self.encoder.encode(reading)
+        return [reading.model_dump_json().encode()]
+
+    async def run(self) -> Dict[str, float]:
+        loop = asyncio.get_running_loop()
+        processor = UDPProcessor(self.logger)
+        await processor.init_udp_listener(self._received, self.port, self.host)
+        transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(self.host, self.port))
+        sent = 0
+        next_sensor = 0
+        try:
+            started = time.perf_counter()
+            while True:
+                elapsed = time.perf_counter() - started
+                if elapsed >= self.duration:
+                    break
+                # Catch up on everything due by now, so the aggregate rate holds even if a tick runs late.
+                for _ in range(int(self.rate * elapsed) - sent):
+                    reading = self.sensors[next_sensor].next_reading()
+                    next_sensor = (next_sensor + 1) % len(self.sensors)
+                    datagrams = self._datagrams(reading)
+                    self._in_flight[(reading.tags["location"], reading.tags["name"], reading.timestamp)] = time.perf_counter()
+                    for datagram in datagrams:
+                        transport.sendto(datagram)
+                    sent += 1
+                await asyncio.sleep(self.tick)
+            send_seconds = time.perf_counter() - started
+            await asyncio.sleep(self.drain_seconds)
+        finally:
+            transport.close()
+            processor.close()
+        latencies = sorted(self._latencies)
+        return {
+            "sent": sent,
+            "received": len(latencies),
+            "dropped": len(self._in_flight),
+            "unexpected": self._unexpected,
+            "target_rate": self.rate,
+            "achieved_rate": sent / send_seconds,
+            "received_rate": len(latencies) / send_seconds,
+            "latency_p50_ms": 1000 * percentile(latencies, 0.50),
+            "latency_p95_ms": 1000 * percentile(latencies, 0.95),
+            "latency_p99_ms": 1000 * percentile(latencies, 0.99),
+            "latency_max_ms": 1000 * latencies[-1] if latencies else math.nan,
+        }
+
+
+def print_report(report: Dict[str, float]):
+    print(f"sent {report['sent']}, received {report['received']}, dropped {report['dropped']} "
+          f"({100 * report['dropped'] / max(report['sent'], 1):.2f}%), unexpected {report['unexpected']}")
+    print(f"rate: target {report['target_rate']:.0f}/s, achieved {report['achieved_rate']:.0f}/s, received {report['received_rate']:.0f}/s")
+    print(f"latency ms: p50 {report['latency_p50_ms']:.2f}, p95 {report['latency_p95_ms']:.2f}, "
+          f"p99 {report['latency_p99_ms']:.2f}, max {report['latency_max_ms']:.2f}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Send SnifferBuddy readings from many virtual sensors to the UDP ingest and measure it.")
+    parser.add_argument("--sensors", type=int, default=200, help="Number of virtual SnifferBuddies.")
+    parser.add_argument("--rate", type=float, default=1000, help="Readings per second from all sensors together.")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to send for.")
+    parser.add_argument("--port", type=int, default=8095)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--binary", action="store_true", help="Send the binary wire format instead of telegraf JSON.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # Per-reading debug logging would swamp the output and the timings.
+    logging.disable(logging.INFO)
+    generator = LoadGenerator(args.sensors, args.rate, args.duration, args.port, args.host, args.binary, args.seed)
+    print_report(asyncio.run(generator.run()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import itertools
+from typing import Callable, Dict, List, Optional
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """Check if an MQTT topic matches a subscription filter.  Supports the '+' (single level) and '#' (multi level) wildcards.
+
+    Args:
+        topic_filter (str): The subscription filter, e.g. 'tele/snifferbuddy/+/+/SENSOR'.
+        topic (str): The topic a message was published to.
+
+    Returns:
+        bool: True if the topic matches the filter.
+    """
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+    for i, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part not in ("+", topic_parts[i]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+class LocalMessage:
+    """Mirrors the attributes of paho's MQTTMessage that our code reads."""
+    def __init__(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class LocalClient:
+    """
+    A stand-in for paho.mqtt.client.Client that is connected to a LocalBroker.  Only the part of the paho API that
+    GrowBuddies uses is implemented (connect, subscribe, unsubscribe, publish, will_set, the loop calls and the
+    on_message callback).  Messages are delivered synchronously on the publishing thread.
+    """
+    def __init__(self, broker: "LocalBroker", client_id: str = ""):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_message: Optional[Callable] = None
+        self.on_connect: Optional[Callable] = None
+        self.userdata = None
+        self.connected = False
+        self._will: Optional[LocalMessage] = None
+        self._subscriptions: List[str] = []
+
+    def will_set(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self._will = LocalMessage(topic, _to_bytes(payload), qos, retain)
+
+    def connect(self, host: str = "localhost", port: int = 1883, keepalive: int = 60):
+        self.connected = True
+        self.broker._attach(self)
+        if self.on_connect:
+            self.on_connect(self, self.userdata, {}, 0)
+        return 0
+
+    def disconnect(self):
+        # A clean disconnect does not fire the last will.
+        self._will = None
+        self.broker._detach(self)
+        self.connected = False
+        return 0
+
+    def drop(self):
+        """Simulate the connection going away without a clean disconnect.  The broker publishes the last will."""
+        will = self._will
+        self._will = None
+        self.broker._detach(self)
+        self.connected = False
+        if will:
+            self.broker.publish(will.topic, will.payload, will.qos, will.retain)
+
+    def loop_start(self):
+        return 0
+
+    def loop_stop(self):
+        return 0
+
+    def subscribe(self, topic: str, qos: int = 0):
+        self._subscriptions.append(topic)
+        self.broker._deliver_retained(self, topic)
+        return (0, 1)
+
+    def unsubscribe(self, topic: str):
+        if topic in self._subscriptions:
+            self._subscriptions.remove(topic)
+        return (0, 1)
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self.broker.publish(topic, payload, qos, retain)
+        return (0, 1)
+
+    def _wants(self, topic: str) -> bool:
+        return any(topic_matches(subscription, topic) for subscription in self._subscriptions)
+
+    def _deliver(self, message: LocalMessage):
+        if self.on_message:
+            self.on_message(self, self.userdata, message)
+
+
+class LocalBroker:
+    """
+    An in-process stand-in for the mosquitto broker.  It is used to test and benchmark code that talks MQTT without
+    needing a broker on the network.  Retained messages are kept the same way mosquitto keeps them:  one per topic,
+    and publishing an empty retained payload clears it.
+    """
+    _client_ids = itertools.count()
+
+    def __init__(self):
+        self._clients: List[LocalClient] = []
+        self._retained: Dict[str, LocalMessage] = {}
+
+    def client(self, client_id: str = "") -> LocalClient:
+        return LocalClient(self, client_id or f"local-{next(self._client_ids)}")
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        message = LocalMessage(topic, _to_bytes(payload), qos, retain)
+        if retain:
+            if message.payload:
+                self._retained[topic] = message
+            else:
+                self._retained.pop(topic, None)
+        # Copy the list since a callback may subscribe or disconnect clients.
+        for client in list(self._clients):
+            if client._wants(topic):
+                # Subscribers see retain=False on live messages, as with a real broker.
+                client._deliver(LocalMessage(topic, message.payload, qos, False))
+
+    def _attach(self, client: LocalClient):
+        if client not in self._clients:
+            self._clients.append(client)
+
+    def _detach(self, client: LocalClient):
+        if client in self._clients:
+            self._clients.remove(client)
+
+    def _deliver_retained(self, client: LocalClient, topic_filter: str):
+        for topic, message in list(self._retained.items()):
+            if topic_matches(topic_filter, topic):
+                client._deliver(message)
+
+
+def _to_bytes(payload) -> bytes:
+    if payload is None:
+        return b""
+    if isinstance(payload, bytes):
+        return payload
+    return str(payload).encode("utf-8")
@@ -9,27 +9,47 @@ from paho.mqtt import publish
 
 import asyncio
 import socket
+import time
+from paho.mqtt import client as mqtt_client
 from paho.mqtt import publish
 
-async def async_publish_single(host, topic, message, logger, timeout=60, max_retries=5):
+from trace_code import Tracer
+
+def new_mqtt_client(client_id: str = ""):
+    """Create a paho client.  paho-mqtt 2.x wants the callback API version spelled out; 1.x does not know about it."""
+    if hasattr(mqtt_client, "CallbackAPIVersion"):
+        return mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION1, client_id=client_id)
+    return mqtt_client.Client(client_id=client_id)
+
+async def async_publish_single(host, topic, message, logger, timeout=60, max_retries=5, publish_single=None):
     loop = asyncio.get_running_loop()
+    # The executor thread does not see our ContextVars, so the trace id is handed over explicitly.
+    trace_id = Tracer.current()
+    # The simulation passes in its broker's stand-in for paho's publish.single.
+    publish_single = publish_single or publish.single
 
-    def publish_message():
-        published = False
+    def publish_message(attempt):
+        start_ns = time.perf_counter_ns()
         try:
-            publish.single(topic, payload=message, hostname=host, qos=1)
-        except asyncio.TimeoutError:
-            logger.warning(f"Publishing timed out on attempt {attempt + 1}. Retrying...")
-        except socket.gaierror as e:
+            publish_single(topic, payload=message, hostname=host, qos=1)
+        except OSError as e:
+            # socket.gaierror, a refused connection and the like.
             logger.warning(f"Attempt {attempt + 1}: Network error - {e}. Retrying...")
-        published = True
-        return published
+            return False
+        finally:
+            Tracer.add_span("publish_single", start_ns, time.perf_counter_ns(), trace_id, topic=topic)
+        return True
 
     for attempt in range(max_retries):
-        published = await asyncio.wait_for(
-            loop.run_in_executor(None, publish_message),
-            timeout=timeout
-        )
+        with Tracer.span("mqtt_publish", topic=topic, attempt=attempt + 1):
+            try:
+                published = await asyncio.wait_for(
+                    loop.run_in_executor(None, publish_message, attempt),
+                    timeout=timeout
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"Publishing timed out on attempt {attempt + 1}. Retrying...")
+                published = False
         if published:
             logger.debug("Message published successfully.")
             return  # Exit the function if publish is successful
@@ -37,7 +57,8 @@ async def async_publish_single(host, topic, message, logger, timeout=60, max_ret
 
         # Wait before retrying, unless this was the last attempt
         if attempt < max_retries - 1:
-            await asyncio.sleep(1)  # Wait before retrying
+            with Tracer.span("mqtt_retry_wait", topic=topic):
+                await asyncio.sleep(1)  # Wait before retrying
 
     # If the function hasn't returned by this point, all retries have failed
     logger.error(f"All {max_retries} attempts to publish the message have failed.")
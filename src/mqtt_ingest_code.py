@@ -0,0 +1,228 @@
+import asyncio
+from collections import deque
+from json import loads
+import math
+import time
+from typing import Any, Callable, Coroutine, Dict, Optional
+
+from pydantic import ValidationError
+
+from logger_code import LoggerBase
+from mqtt_code import new_mqtt_client
+from pydantic_models import SensorDataModel, SnifferBuddyModel
+
+SNIFFERBUDDY_TOPIC = "tele/snifferbuddy/+/+/SENSOR"
+# The Tasmota names of the SnifferBuddy readings and what telegraf's processors.rename turns them into.
+# Tasmota nests the readings (e.g. {"SCD40": {"CarbonDioxide": 800}}), telegraf's json parser flattens them into SCD40_CarbonDioxide.
+FIELD_RENAMES = {
+    ("SCD40", "Humidity"): "humidity",
+    ("SCD40", "Temperature"): "temperature",
+    ("SCD40", "eCO2"): "eCO2",
+    ("SCD40", "CarbonDioxide"): "CO2",
+    ("SCD40", "DewPoint"): "dewpoint",
+    ("ANALOG", "A0"): "light",
+}
+# The photoresistor on A0 reads higher when the grow light is on.  lightmod_vpd.star lives in /etc/telegraf, not in this
+# repo, so this threshold is a guess at its cutoff rather than a copy of it.  Check it against the script before relying
+# on the light state from the MQTT ingest.
+LIGHT_ON_THRESHOLD = 300
+
+
+def calc_vpd(temperature: float, humidity: float) -> float:
+    """
+    Approximate the vapor pressure deficit (in kPa) that the lightmod_vpd.star telegraf script adds.  The script is not
+    in this repo, so this uses the Tetens equation with air temperature only.  It may differ from the script in the
+    second decimal place (e.g. if the script uses a leaf temperature offset or other constants).
+
+    Args:
+        temperature (float): Air temperature in Celsius.
+        humidity (float): Relative humidity in percent.
+
+    Returns:
+        float: The VPD in kPa, rounded to two places.
+    """
+    # Tetens equation for the saturation vapor pressure.
+    svp = 0.61078 * math.exp(17.27 * temperature / (temperature + 237.3))
+    return round(svp * (1 - humidity / 100), 2)
+
+
+def light_state(analog_value: float, threshold: float = LIGHT_ON_THRESHOLD) -> int:
+    """Turn the raw A0 reading into 1 (light on) or 0 (light off)."""
+    return 1 if analog_value > threshold else 0
+
+
+def parse_snifferbuddy_message(topic: str, payload: bytes, timestamp: Optional[int] = None) -> SnifferBuddyModel:
+    """
+    Turn a Tasmota SENSOR message into the SnifferBuddyModel telegraf would have sent over UDP.  This does the work
+    of telegraf's mqtt_consumer topic parsing and processors.rename, and approximates the lightmod_vpd.star script
+    (see LIGHT_ON_THRESHOLD and calc_vpd).
+
+    Args:
+        topic (str): The MQTT topic, tele/snifferbuddy/<location>/<name>/SENSOR.
+        payload (bytes): The Tasmota JSON payload.
+        timestamp (int, optional): Seconds since the epoch.  Defaults to now, which is what telegraf uses.
+
+    Returns:
+        SnifferBuddyModel: The validated reading.
+
+    Raises:
+        ValueError: If the topic does not look like a SnifferBuddy topic.
+        pydantic.ValidationError: If a field is missing from the payload.
+    """
+    parts = topic.split("/")
+    if len(parts) != 5:
+        raise ValueError(f"{topic} is not a SnifferBuddy topic.")
+    _, _, location, name, _ = parts
+    tasmota = loads(payload)
+    fields: Dict[str, Any] = {}
+    for (sensor, tasmota_name), field_name in FIELD_RENAMES.items():
+        value = tasmota.get(sensor, {}).get(tasmota_name)
+        if value is not None:
+            fields[field_name] = value
+    if "light" in fields:
+        fields["light"] = light_state(fields["light"])
+    if "temperature" in fields and "humidity" in fields:
+        fields["vpd"] = calc_vpd(fields["temperature"], fields["humidity"])
+    return SnifferBuddyModel(
+        fields=SensorDataModel(**fields),
+        name="snifferbuddy",
+        tags={"location": location, "name": name},
+        timestamp=int(time.time()) if timestamp is None else timestamp,
+    )
+
+
+class SnifferBuddyMQTTIngest:
+    """
+    Subscribes to the SnifferBuddy MQTT topics directly and hands each reading to a callback as a SnifferBuddyModel.
+    This skips the telegraf -> UDP hop and its 30 second aggregation window, so a reading gets to the PID controller
+    milliseconds after the SnifferBuddy publishes it.  The callback is the same one UDPProcessor takes.
+    """
+    def __init__(self, logger, callback: Callable[[SnifferBuddyModel], Coroutine], hostname: str = "gus.local", port: int = 1883, topic: str = SNIFFERBUDDY_TOPIC, client=None):
+        self.logger = logger
+        self.callback = callback
+        self.hostname = hostname
+        self.port = port
+        self.topic = topic
+        # Anything with paho's Client interface works.  Tests and benchmarks pass in a LocalBroker client.
+        self.client = client if client is not None else new_mqtt_client()
+        self.loop = None
+        self._tasks = set()
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.client.on_message = self._on_message
+        self.client.connect(self.hostname, self.port)
+        self.client.subscribe(self.topic)
+        # paho runs its network loop (and so on_message) in its own thread.
+        self.client.loop_start()
+        self.logger.debug(f"Subscribed to {self.topic} on {self.hostname}:{self.port}")
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def _on_message(self, client, userdata, message):
+        try:
+            sniffer_buddy = parse_snifferbuddy_message(message.topic, message.payload)
+        except (ValueError, ValidationError) as e:
+            self.logger.error(f"Could not turn the message on {message.topic} into a SnifferBuddy reading: {e}")
+            return
+        self.loop.call_soon_threadsafe(self._dispatch, sniffer_buddy)
+
+    def _dispatch(self, sniffer_buddy: SnifferBuddyModel):
+        task = self.loop.create_task(self.callback(sniffer_buddy))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+class TelegrafStandIn:
+    """
+    Stands in for the telegraf pipeline for the latency comparison:  it averages the readings per location over the
+    basicstats period, holds the result until the next flush and then sends it over UDP as telegraf JSON.
+    """
+    def __init__(self, broker_client, udp_port: int, period: float = 30, flush_interval: float = 10):
+        self.client = broker_client
+        self.udp_port = udp_port
+        self.period = period
+        self.flush_interval = flush_interval
+        self.window = {}
+        # perf_counter times of the readings in each mean that has been sent, oldest first.
+        self.sent_windows = deque()
+
+    def _on_message(self, client, userdata, message):
+        reading = parse_snifferbuddy_message(message.topic, message.payload)
+        self.window.setdefault(reading.tags["location"], []).append((reading, time.perf_counter()))
+
+    async def run(self, duration: float):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=("127.0.0.1", self.udp_port))
+        self.client.on_message = self._on_message
+        self.client.connect()
+        self.client.subscribe(SNIFFERBUDDY_TOPIC)
+        end = loop.time() + duration
+        next_period = loop.time() + self.period
+        while loop.time() < end:
+            await asyncio.sleep(next_period - loop.time())
+            next_period += self.period
+            window, self.window = self.window, {}
+            # The aggregated metric is written out on the next flush tick.
+            await asyncio.sleep(self.flush_interval)
+            for entries in window.values():
+                readings = [reading for reading, _ in entries]
+                fields = {}
+                for field_name in SensorDataModel.model_fields:
+                    fields[field_name] = sum(getattr(r.fields, field_name) for r in readings) / len(readings)
+                fields["light"] = round(fields["light"])
+                mean = SnifferBuddyModel(fields=SensorDataModel(**fields), name="mean_values", tags=readings[-1].tags, timestamp=readings[-1].timestamp)
+                self.sent_windows.append([received for _, received in entries])
+                transport.sendto(mean.model_dump_json().encode())
+        transport.close()
+
+
+async def compare_latency(readings: int = 12, interval: float = 10, period: float = 30, flush_interval: float = 10, udp_port: int = 8095):
+    """Publish readings to a LocalBroker and time how long they take to reach a callback through each ingest path."""
+    from local_broker_code import LocalBroker
+    from process_udp_code import UDPProcessor
+
+    logger = LoggerBase.setup_logger('MQTTIngestBenchmark')
+    broker = LocalBroker()
+    published = []
+    direct_latencies = []
+    telegraf_latencies = []
+    telegraf = TelegrafStandIn(broker.client(), udp_port, period, flush_interval)
+
+    async def direct_callback(reading):
+        direct_latencies.append(time.perf_counter() - published[-1])
+
+    async def telegraf_callback(reading):
+        # Every reading that went into the mean waited until the mean arrived.
+        arrived = time.perf_counter()
+        telegraf_latencies.extend(arrived - sent for sent in telegraf.sent_windows.popleft())
+
+    ingest = SnifferBuddyMQTTIngest(logger, direct_callback, client=broker.client())
+    await ingest.start()
+    udp = UDPProcessor(logger)
+    await udp.init_udp_listener(telegraf_callback, udp_port, host='127.0.0.1')
+    telegraf_task = asyncio.create_task(telegraf.run(readings * interval + period))
+    payload = '{"ANALOG":{"A0":512},"SCD40":{"CarbonDioxide":812,"eCO2":790,"Temperature":25.3,"Humidity":58.1,"DewPoint":16.5}}'
+    for _ in range(readings):
+        published.append(time.perf_counter())
+        broker.publish("tele/snifferbuddy/tent_one/sniffer_one/SENSOR", payload)
+        await asyncio.sleep(interval)
+    await telegraf_task
+    ingest.stop()
+    udp.close()
+    for label, latencies in (("direct MQTT", direct_latencies), ("telegraf UDP", telegraf_latencies)):
+        if latencies:
+            print(f"{label:>13}: {len(latencies)} readings, mean {1000 * sum(latencies) / len(latencies):.3f} ms, max {1000 * max(latencies):.3f} ms")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Compare reading latency of the direct MQTT ingest against the telegraf UDP path.")
+    parser.add_argument("--readings", type=int, default=12)
+    parser.add_argument("--interval", type=float, default=10, help="Seconds between SnifferBuddy readings (Tasmota TelePeriod).")
+    parser.add_argument("--period", type=float, default=30, help="telegraf basicstats period in seconds.")
+    parser.add_argument("--flush", type=float, default=10, help="telegraf flush_interval in seconds.")
+    args = parser.parse_args()
+    asyncio.run(compare_latency(args.readings, args.interval, args.period, args.flush))
@@ -0,0 +1,181 @@
+"""
+Offline Q-learning from recorded PID traces.  PIDStateRecorder appends every PIDState a controller puts out to a JSON
+lines file, together with the tent, the controller, the setpoint and the reading's timestamp.  train_offline() turns
+months of those records into (state, action, reward, next_state) batches and fits a Q-table to them, so live tuning
+starts from what the recorded tents already showed instead of from zeros.
+
+The states and actions are the ones QLearningAgent uses:
+    state   the error (setpoint - value) put into one of 10 bins between -limit and +limit.
+    action  how far the tuned gain moved before the next record, in gain steps from -10 to +10, stored as 0 to 20.
+    reward  -|error| of the next record.
+
+Example:
+    python src/offline_q_training_code.py traces/*.jsonl --controller VPD --gain Kp --out q_table_vpd.npy
+"""
+import argparse
+from json import dumps, loads
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+from pydantic_models import PIDState
+
+STATE_SPACE_SIZE = 10
+ACTION_SPACE_SIZE = 21
+# The error at which the outer bins start, in the units of what is controlled (ppm for CO2, kPa for VPD).
+ERROR_LIMITS = {"CO2": 500, "VPD": 0.5}
+# How much one action step changes the gain.  GrowTentEnv.apply_action uses these too.
+GAIN_STEPS = {"CO2": 0.1, "VPD": 1.0}
+# Records further apart than this are not treated as one step, e.g. across the night or a restart.
+MAX_GAP_SECONDS = 120
+
+
+class PIDStateRecorder:
+    """Appends PIDStates to a JSON lines file.  One line per PID step."""
+    def __init__(self, path: str):
+        self.path = path
+        # Line buffered so a crash loses at most the line being written.
+        self._file = open(path, "a", buffering=1, encoding="utf-8")
+
+    def record(self, pid_state: PIDState, tent_name: str, controller_type: str, setpoint: float, timestamp: int):
+        record = pid_state.model_dump()
+        record.update(tent_name=tent_name, controller_type=controller_type.upper(), setpoint=setpoint, timestamp=timestamp)
+        self._file.write(dumps(record) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+def read_pid_traces(paths: Iterable[str], controller_type: Optional[str] = None) -> Dict[str, np.ndarray]:
+    """
+    Read recorded traces into columns, sorted by tent, controller and time.  Records without a value are skipped.
+
+    Returns:
+        dict: Column name to array.  Keys are tent, controller, timestamp, value, setpoint, Kp, Ki and Kd.
+    """
+    rows = []
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                record = loads(line)
+                if record.get("value") is None or record.get("timestamp") is None:
+                    continue
+                if controller_type and record["controller_type"] != controller_type.upper():
+                    continue
+                rows.append((record["tent_name"], record["controller_type"], record["timestamp"], record["value"],
+                             record["setpoint"], record["Kp"], record["Ki"], record["Kd"]))
+    rows.sort(key=lambda row: row[:3])
+    names = ("tent", "controller", "timestamp", "value", "setpoint", "Kp", "Ki", "Kd")
+    if not rows:
+        return {name: np.array([]) for name in names}
+    columns = list(zip(*rows))
+    traces = {"tent": np.array(columns[0]), "controller": np.array(columns[1]), "timestamp": np.array(columns[2], dtype=np.int64)}
+    traces.update({name: np.array(column, dtype=float) for name, column in zip(names[3:], columns[3:])})
+    return traces
+
+
+def discretize_error(errors: np.ndarray, limit: float, bins: int = STATE_SPACE_SIZE) -> np.ndarray:
+    """Put errors into `bins` equal bins between -limit and +limit.  Errors past the limits go in the outer bins."""
+    edges = np.linspace(-limit, limit, bins + 1)[1:-1]
+    return np.digitize(errors, edges)
+
+
+def build_transitions(traces: Dict[str, np.ndarray], gain: str = "Kp", error_limit: Optional[float] = None,
+                      gain_step: Optional[float] = None, max_gap: float = MAX_GAP_SECONDS) -> Dict[str, np.ndarray]:
+    """
+    Turn traces from read_pid_traces() into transitions between consecutive records of the same tent and controller.
+
+    Args:
+        traces (dict): The columns read_pid_traces() returns.  All rows must be for the same kind of controller.
+        gain (str): The gain being tuned, Kp, Ki or Kd.  Its change between records is the action.
+        error_limit (float, optional): Where the outer error bins start.  Defaults to ERROR_LIMITS for the controller.
+        gain_step (float, optional): The gain change of one action step.  Defaults to GAIN_STEPS for the controller.
+        max_gap (float): Records more than this many seconds apart end an episode.
+
+    Returns:
+        dict: states, actions, rewards, next_states and dones, one entry per transition.
+    """
+    if len(traces["timestamp"]) < 2:
+        empty = np.array([], dtype=np.intp)
+        return {"states": empty, "actions": empty, "rewards": np.array([]), "next_states": empty, "dones": np.array([], dtype=bool)}
+    controller = str(traces["controller"][0])
+    error_limit = ERROR_LIMITS[controller] if error_limit is None else error_limit
+    gain_step = GAIN_STEPS[controller] if gain_step is None else gain_step
+    errors = traces["setpoint"] - traces["value"]
+    states = discretize_error(errors, error_limit)
+    # Row i and row i + 1 make a transition when they are the same controller on the same tent and close enough in time.
+    linked = ((traces["tent"][1:] == traces["tent"][:-1]) & (traces["controller"][1:] == traces["controller"][:-1])
+              & (np.diff(traces["timestamp"]) <= max_gap))
+    half = ACTION_SPACE_SIZE // 2
+    steps = np.rint(np.diff(traces[gain]) / gain_step)
+    actions = np.clip(steps, -half, half).astype(np.intp) + half
+    # The episode ends at a transition whose next record has nothing linked after it.
+    continues = np.append(linked[1:], False)
+    return {
+        "states": states[:-1][linked],
+        "actions": actions[linked],
+        "rewards": -np.abs(errors[1:])[linked],
+        "next_states": states[1:][linked],
+        "dones": ~continues[linked],
+    }
+
+
+def fit_q_table(transitions: Dict[str, np.ndarray], discount_rate: float = 0.99, sweeps: int = 2000, tolerance: float = 1e-6,
+                q_table: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Fitted Q iteration over the whole batch.  Each sweep sets every (state, action) pair that appears in the data to the
+    mean of r + discount * max Q(next_state) over its transitions, all pairs at once with np.bincount.  Sweeps stop once
+    no value moves by more than `tolerance`.
+
+    Pairs that never appear in the data are set to the lowest value of their state afterwards, so the greedy policy
+    prefers the actions the recorded tents actually took over ones nobody has tried.
+
+    Returns:
+        np.ndarray: The (states, actions) Q-table.
+    """
+    size = STATE_SPACE_SIZE * ACTION_SPACE_SIZE
+    q = np.zeros(size) if q_table is None else np.asarray(q_table, dtype=float).ravel().copy()
+    index = transitions["states"] * ACTION_SPACE_SIZE + transitions["actions"]
+    counts = np.bincount(index, minlength=size)
+    visited = counts > 0
+    if not visited.any():
+        return q.reshape(STATE_SPACE_SIZE, ACTION_SPACE_SIZE)
+    not_done = ~transitions["dones"]
+    for _ in range(sweeps):
+        future = q.reshape(STATE_SPACE_SIZE, ACTION_SPACE_SIZE).max(axis=1)[transitions["next_states"]]
+        targets = transitions["rewards"] + discount_rate * future * not_done
+        new_q = q.copy()
+        new_q[visited] = np.bincount(index, weights=targets, minlength=size)[visited] / counts[visited]
+        change = np.abs(new_q - q).max()
+        q = new_q
+        if change < tolerance:
+            break
+    q = q.reshape(STATE_SPACE_SIZE, ACTION_SPACE_SIZE)
+    visited = visited.reshape(q.shape)
+    lowest = np.where(visited, q, np.inf).min(axis=1, keepdims=True)
+    return np.where(visited | ~np.isfinite(lowest), q, lowest)
+
+
+def train_offline(paths: Iterable[str], controller_type: str, gain: str = "Kp", discount_rate: float = 0.99, **kwargs) -> np.ndarray:
+    """
+    Read the traces of one kind of controller and fit a Q-table to them.  Load the result with
+    QLearningAgent(logger, q_table=...) or QAgentBank.load_q_table().
+    """
+    traces = read_pid_traces(paths, controller_type)
+    transitions = build_transitions(traces, gain, **kwargs)
+    return fit_q_table(transitions, discount_rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train a Q-table from recorded PID traces.")
+    parser.add_argument("paths", nargs="+", help="JSON lines files written by PIDStateRecorder.")
+    parser.add_argument("--controller", required=True, choices=["CO2", "VPD"])
+    parser.add_argument("--gain", default="Kp", choices=["Kp", "Ki", "Kd"])
+    parser.add_argument("--discount-rate", type=float, default=0.99)
+    parser.add_argument("--out", required=True, help="Where to save the Q-table (.npy).")
+    args = parser.parse_args()
+    q_table = train_offline(args.paths, args.controller, args.gain, args.discount_rate)
+    np.save(args.out, q_table)
+    print(f"Saved a {q_table.shape[0]}x{q_table.shape[1]} Q-table to {args.out}")
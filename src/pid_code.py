@@ -11,6 +11,8 @@ from typing import Any, Callable, Optional
 
 from logger_code import LoggerBase
 from pydantic_models import PidConfigModel, PIDState
+from signal_filter_code import SignalConditioner
+from trace_code import Tracer
 
 class ControllerType(Enum):
     CO2 = "CO2",
@@ -36,7 +38,8 @@ def _clamp(value, limits):
 
 
 class PID_Controller(object):
-    def __init__(self, tent_name:str, controller_type:str, pid_config: PidConfigModel, callback: Optional[Callable[..., Any]] = None) -> None:
+    def __init__(self, tent_name:str, controller_type:str, pid_config: PidConfigModel, callback: Optional[Callable[..., Any]] = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
         self.logger = LoggerBase.setup_logger('PID_Control')
         self.config = pid_config
         self.tent_name = tent_name
@@ -56,7 +59,13 @@ class PID_Controller(object):
         self._Kd = pid_config.Kd
 
 
-        self._last_time = time.monotonic()
+        # Where the time between readings comes from when they have no timestamp.  The simulation hands in its virtual clock.
+        self._clock = clock
+        self._last_time = clock()
+        self._last_timestamp = None
+
+        # Smooth the readings and drop outliers before they get to the PID terms.  The derivative term is especially jumpy on raw readings.
+        self.signal_conditioner = SignalConditioner(pid_config.signal_filter) if pid_config.signal_filter else None
 
         # For co2, getting too far about the setpoint is dangerous.
         # For vpd, getting too far below the setpoint invites pathogens and powdery mildew.
@@ -67,12 +76,23 @@ class PID_Controller(object):
         else:
             self.sign = -1
 
-    def __call__(self, current_value:float) -> float:
+    def __call__(self, current_value:float, timestamp: Optional[int] = None) -> float:
+        with Tracer.span("pid_step", value=current_value):
+            return self._step(current_value, timestamp)
+
+    def _step(self, current_value:float, timestamp: Optional[int] = None) -> float:
+        if self.signal_conditioner:
+            current_value = self.signal_conditioner(current_value)
 
-        # Determine if it is time to tune.
-        now = time.monotonic()
-        dt = now - self._last_time if (now - self._last_time) else 1e-16
-        self._last_time = now
+        if timestamp is None:
+            now = self._clock()
+            dt = now - self._last_time if (now - self._last_time) else 1e-16
+            self._last_time = now
+        else:
+            # The reading's own timestamp (seconds since the epoch) gives the real time between readings, however long they took to get here.
+            # Timestamps are whole seconds, so two readings in the same second are treated as one second apart.
+            dt = max(timestamp - self._last_timestamp, 1) if self._last_timestamp is not None else 1
+            self._last_timestamp = timestamp
 
         # d_value calculates the difference between the current reading and the last reading. It's used to determine how much the value has changed since the last update, which is important for the Derivative part of PID, focusing on the rate of change.
         d_value = current_value - (
@@ -95,7 +115,8 @@ class PID_Controller(object):
         current_pid_state = self._set_current_pid_state(self._proportional, self._integral, self._derivative, current_value,seconds_on)
         self.logger.debug(f"--------------------\nPID State:\n{current_pid_state.model_dump_json(indent=4)}")
         loop = asyncio.get_running_loop()
-        loop.create_task(self.callback(current_pid_state))
+        # The callback also gets the reading's timestamp (None if it had none), so it can tell which reading the state is for.
+        loop.create_task(self.callback(current_pid_state, timestamp))
 
 
         return seconds_on
@@ -1,35 +1,109 @@
 import asyncio
+import time
+from typing import Awaitable, Callable, Optional
 from pydantic import ValidationError
 from pydantic_models import SnifferBuddyModel
 from snifferbuddy_queue_code import SnifferBuddyQueue
+from trace_code import Tracer
+from wire_format_code import DecodedReading, SnifferBuddyDecoder, SnifferBuddyReading, is_binary
 
 class SimpleUDPServer(asyncio.DatagramProtocol):
-    def __init__(self, logger):
+    def __init__(self, logger, callback: Optional[Callable[[SnifferBuddyReading], Awaitable]] = None, sensor_bus=None):
         self.logger = logger
+        # When a callback is given, validated readings are handed to it.  Otherwise they go on the SnifferBuddyQueue.
+        # The callback gets binary readings as DecodedReadings.  The queue always gets SnifferBuddyModels.
+        self.callback = callback
+        # A SensorBusWriter gets every validated reading too, for the local processes that read the shared-memory bus.
+        self.sensor_bus = sensor_bus
+        self.decoder = SnifferBuddyDecoder()
+        self._tasks = set()
 
     def connection_made(self, transport):
         self.transport = transport
         self.logger.debug(f"UDP Server started on {transport.get_extra_info('sockname')}")
 
-    async def datagram_received(self, data, addr):
-        message = data.decode()
-        self.logger.debug(f"Received UDP snifferbuddy reading: {message} from {addr}")
-        try:
-            sniffer_buddy = SnifferBuddyModel.model_validate_json(message)
-            await SnifferBuddyQueue.put(sniffer_buddy)
-            self.logger.debug("Validated snifferbuddy reading and added to processing queue.")
-        except ValidationError as e:
-            self.logger.error(f"Validation error for received data: {e}")
-            return False
+    def datagram_received(self, data, addr):
+        # Each sampled datagram gets a trace id.  Tasks created below carry it through the rest of the pipeline.
+        trace_id = Tracer.start_trace()
+        if trace_id is None:
+            return self._receive(data, addr)
+        with Tracer.activate(trace_id), Tracer.span("datagram_received", bytes=len(data)):
+            return self._receive(data, addr)
+
+    def _receive(self, data, addr):
+        # asyncio calls datagram_received as a plain function, so the work that needs to await is scheduled as a task.
+        with Tracer.span("decode"):
+            if is_binary(data):
+                # Compact binary readings share the port with telegraf's JSON.
+                try:
+                    sniffer_buddy = self.decoder.decode(data, addr)
+                except ValueError as e:
+                    self.logger.error(f"Could not decode binary reading from {addr}: {e}")
+                    return False
+                if sniffer_buddy is None:
+                    # A name table update.  There is no reading to pass on.
+                    return True
+            else:
+                message = data.decode()
+                self.logger.debug(f"Received UDP snifferbuddy reading: {message} from {addr}")
+                try:
+                    sniffer_buddy = SnifferBuddyModel.model_validate_json(message)
+                except ValidationError as e:
+                    self.logger.error(f"Validation error for received data: {e}")
+                    return False
+        if self.sensor_bus:
+            self.sensor_bus.publish(sniffer_buddy)
+        if self.callback:
+            if Tracer.current() is None:
+                coroutine = self.callback(sniffer_buddy)
+            else:
+                coroutine = self._traced_callback(sniffer_buddy, time.perf_counter_ns())
+            task = asyncio.get_running_loop().create_task(coroutine)
+            # Hold a reference until the task is done so it is not garbage collected mid-flight.
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif not self.sensor_bus:
+            if isinstance(sniffer_buddy, DecodedReading):
+                sniffer_buddy = sniffer_buddy.to_model()
+            SnifferBuddyQueue.put_nowait(sniffer_buddy)
+        self.logger.debug("Validated snifferbuddy reading and passed it on for processing.")
         return True
 
+    async def _traced_callback(self, sniffer_buddy, queued_ns):
+        # How long the reading waited for the event loop to get to its task.
+        Tracer.add_span("task_wait", queued_ns, time.perf_counter_ns())
+        await self.callback(sniffer_buddy)
+
     def error_received(self, exc):
-        self.logger.error('UDP error received:', exc)
+        self.logger.error(f'UDP error received: {exc}')
 
     def connection_lost(self, exc):
-        self.logger.debug('UDP connection closed:', exc)
+        self.logger.debug(f'UDP connection closed: {exc}')
         self.transport.close()
 
+class UDPProcessor:
+    """
+    Listens for the SnifferBuddy readings telegraf sends over UDP and hands each validated reading to a callback.  The
+    callback is given a SnifferBuddyModel for a JSON datagram and a DecodedReading for a binary one.  Both have the
+    fields, name, tags and timestamp attributes.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        self.transport = None
+
+    async def init_udp_listener(self, callback: Callable[[SnifferBuddyReading], Awaitable], port: int = 8095, host: str = '0.0.0.0', sensor_bus=None):
+        loop = asyncio.get_running_loop()
+        self.transport, protocol = await loop.create_datagram_endpoint(
+            lambda: SimpleUDPServer(self.logger, callback, sensor_bus),
+            local_addr=(host, port)
+        )
+        return protocol
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+
 async def fill_queue(port, logger):
     loop = asyncio.get_running_loop()
     _, protocol = await loop.create_datagram_endpoint(
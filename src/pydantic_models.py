@@ -12,6 +12,19 @@ class MonitorParam(Enum):
 
 class GlobalSettingsModel(BaseModel):
     log_level: str # TODO: Right now, the log level is set to whatever..I haven't paid attention.
+class SignalFilterModel(BaseModel):
+    kind: str = "none"  # One of none, mean, ema or median.
+    window: int = Field(default=5, ge=1)  # Number of readings in the mean, median and outlier windows.
+    alpha: float = Field(default=0.3, gt=0, le=1)  # Smoothing factor of the ema.
+    outlier_sigma: Optional[float] = None  # Readings further than this many standard deviations from the window mean are replaced.  None turns outlier rejection off.
+
+    @field_validator('kind')
+    @classmethod
+    def check_kind(cls, v):
+        if v.lower() not in ["none", "mean", "ema", "median"]:
+            raise ValueError("Invalid signal filter. Must be 'none', 'mean', 'ema' or 'median'")
+        return v.lower()
+
 class PidConfigModel(BaseModel):
     active: bool
     hostname:str
@@ -25,6 +38,7 @@ class PidConfigModel(BaseModel):
     comparison_function: str
     mqtt_power_topics: List[str]
     telegraf_fieldname: str
+    signal_filter: Optional[SignalFilterModel] = None
 
     @field_validator('comparison_function')
     @classmethod
@@ -49,6 +63,11 @@ class GlobalConfig:
     def get_model(cls):
         return cls._model
 
+    @classmethod
+    def set_model(cls, model: GlobalConfigModel):
+        """Use a config that was built in code (e.g. by a test harness) instead of loading the config file."""
+        cls._model = model
+
     @classmethod
     def update(cls, **kwargs):
         for key, value in kwargs.items():
@@ -107,6 +126,23 @@ class GrowTentParams(BaseModel):
     hostname: Optional[str] = "gus.local"
     snifferbuddy_incoming_port: Optional[int]=8095
     mqtt_power_topics: Optional[List[str]] = []
+    # "udp" listens for the readings telegraf forwards.  "mqtt" subscribes to the SnifferBuddy topics directly.  "none"
+    # listens for nothing:  whoever runs the environment hands it readings, e.g. TentSupervisor from its one UDP listener.
+    ingest: Optional[str] = "udp"
+    # When set, every reading for the tent is kept in a columnar history store under this directory.
+    history_dir: Optional[str] = None
+    # How long a reading is held so one that arrives a little late can be put back in timestamp order.
+    jitter_hold_seconds: Optional[float] = 0.5
+    # Send Power/PulseTime commands through the shared, rate limited ActuationScheduler instead of publishing right away.
+    use_actuation_scheduler: Optional[bool] = False
+    # Raise the SnifferBuddy's TelePeriod while tuning or far from the setpoint and lower it when the tent is settled.
+    adaptive_telemetry: Optional[bool] = False
+    # When set, every PIDState is appended to this JSON lines file so Q-tables can be trained offline from it.
+    pid_trace_path: Optional[str] = None
+    # Fuse the readings of all the SnifferBuddies in the tent into one reading per tick before they go to the PID.
+    fuse_sensors: Optional[bool] = False
+    fusion_tick_seconds: Optional[float] = 10
+    fusion_stale_seconds: Optional[float] = 60
     sensor_reading_callback: Optional[Callable[..., Coroutine]] = None
     PID_state_callback: Optional[Callable[..., Coroutine]] = None
 
@@ -118,6 +154,14 @@ class GrowTentParams(BaseModel):
             raise ValueError(f"Invalid value: {v}. Expected one of {allowed_values}")
         return v
 
+    @field_validator('ingest')
+    @classmethod
+    def ingest_must_be_one_of_these(cls, v):
+        allowed_values = {"udp", "mqtt", "none"}
+        if v.lower() not in allowed_values:
+            raise ValueError(f"Invalid value: {v}. Expected one of {allowed_values}")
+        return v.lower()
+
     @field_validator('tent_name')
     @classmethod
     def name_must_be_string(cls, v):
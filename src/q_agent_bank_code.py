@@ -0,0 +1,88 @@
+from typing import Optional, Sequence
+
+import numpy as np
+
+
+class QAgentBank:
+    """
+    Many Q-learning agents (one per tent/controller being tuned) kept in one (agents, states, actions) array, so choosing
+    actions and updating the Q-tables for all of them is a handful of NumPy calls instead of a Python loop over
+    QLearningAgent objects.  The learning rule and epsilon-greedy policy are the same as QLearningAgent's.
+
+    Each agent has its own seeded random generator, so an agent makes the same choices whichever other agents share the
+    bank.  The generators fill a block of random numbers per agent ahead of time and each step reads one column of it.
+    """
+    def __init__(self, num_agents: int, seeds: Optional[Sequence[int]] = None, state_space_size: int = 10, action_space_size: int = 21,
+                 learning_rate: float = 0.1, discount_rate: float = 0.99, exploration_rate: float = 1.0, exploration_decay: float = 0.995,
+                 min_exploration_rate: float = 0.01, random_block: int = 256):
+        self.num_agents = num_agents
+        self.state_space_size = state_space_size
+        self.action_space_size = action_space_size
+        self.learning_rate = learning_rate
+        self.discount_rate = discount_rate
+        self.exploration_decay = exploration_decay
+        self.min_exploration_rate = min_exploration_rate
+        self.q_tables = np.zeros((num_agents, state_space_size, action_space_size))
+        self.exploration_rates = np.full(num_agents, exploration_rate)
+        seeds = range(num_agents) if seeds is None else seeds
+        if len(seeds) != num_agents:
+            raise ValueError(f"Got {len(seeds)} seeds for {num_agents} agents.")
+        self._generators = [np.random.default_rng(seed) for seed in seeds]
+        self._agents = np.arange(num_agents)
+        # Two numbers per agent per step:  one for explore or exploit, one for the random action.
+        self._random = np.empty((num_agents, random_block, 2))
+        self._cursor = random_block
+
+    def _draw(self) -> np.ndarray:
+        if self._cursor == self._random.shape[1]:
+            for agent, generator in enumerate(self._generators):
+                self._random[agent] = generator.random(self._random.shape[1:])
+            self._cursor = 0
+        draws = self._random[:, self._cursor]
+        self._cursor += 1
+        return draws
+
+    def decide_actions(self, states: np.ndarray) -> np.ndarray:
+        """
+        Pick an action for every agent with the epsilon-greedy policy.
+
+        Args:
+            states (np.ndarray): The discretized error bin each agent is in, shape (agents,).
+
+        Returns:
+            np.ndarray: The index of the action each agent takes, shape (agents,).
+        """
+        draws = self._draw()
+        explore = draws[:, 0] < self.exploration_rates
+        random_actions = np.minimum((draws[:, 1] * self.action_space_size).astype(np.intp), self.action_space_size - 1)
+        greedy_actions = np.argmax(self.q_tables[self._agents, states], axis=1)
+        return np.where(explore, random_actions, greedy_actions)
+
+    def update_policies(self, states: np.ndarray, actions: np.ndarray, rewards: np.ndarray, next_states: np.ndarray, dones: np.ndarray,
+                        active: Optional[np.ndarray] = None) -> None:
+        """
+        Apply the Q-learning update to every agent at once.  All arguments have shape (agents,).
+
+        Args:
+            states (np.ndarray): The state each agent acted in.
+            actions (np.ndarray): The action each agent took.
+            rewards (np.ndarray): The reward each agent got.
+            next_states (np.ndarray): The state each agent ended up in.
+            dones (np.ndarray): True where the agent's episode has ended.  Their exploration rate is left alone.
+            active (np.ndarray, optional): True for the agents that actually stepped.  The others are not touched.
+        """
+        active = np.ones(self.num_agents, dtype=bool) if active is None else np.asarray(active, dtype=bool)
+        future_rewards = self.q_tables[self._agents, next_states].max(axis=1)
+        old_values = self.q_tables[self._agents, states, actions]
+        new_values = old_values + self.learning_rate * (rewards + self.discount_rate * future_rewards - old_values)
+        self.q_tables[self._agents, states, actions] = np.where(active, new_values, old_values)
+        decay = active & ~np.asarray(dones, dtype=bool)
+        self.exploration_rates = np.where(decay, np.maximum(self.min_exploration_rate, self.exploration_rates * self.exploration_decay), self.exploration_rates)
+
+    def q_table(self, agent: int) -> np.ndarray:
+        """One agent's Q-table.  It is a view, so changes to it change the bank."""
+        return self.q_tables[agent]
+
+    def load_q_table(self, agent: int, q_table) -> None:
+        """Start an agent from a table learned elsewhere, e.g. one shared by another node or trained offline."""
+        self.q_tables[agent] = np.asarray(q_table, dtype=float).reshape(self.state_space_size, self.action_space_size)
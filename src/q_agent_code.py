@@ -1,11 +1,15 @@
 import numpy as np
 
-from heatmap_animator_code import HeatmapAnimator
-from q_datahandler_code import QDataHandler
+try:
+    from heatmap_animator_code import HeatmapAnimator
+    from q_datahandler_code import QDataHandler
+except ImportError:
+    # The heatmap needs matplotlib and the Q data handler.  Without them the agent learns just the same, unwatched.
+    HeatmapAnimator = QDataHandler = None
 
 
 class QLearningAgent:
-    def __init__(self, logger, learning_rate=0.1, discount_rate=0.99, exploration_rate=1.0, exploration_decay=0.995, min_exploration_rate=0.01):
+    def __init__(self, logger, learning_rate=0.1, discount_rate=0.99, exploration_rate=1.0, exploration_decay=0.995, min_exploration_rate=0.01, q_table=None):
         self.logger = logger
         # Set the state space size based on the number of bins for discretizing the error
         self.state_space_size = 10  # 10 bins for the discretized error
@@ -20,12 +24,16 @@ class QLearningAgent:
         self.exploration_decay = exploration_decay
         self.min_exploration_rate = min_exploration_rate
 
-        # Initialize the Q-table with zeros
-        self.q_table = np.zeros((self.state_space_size, self.action_space_size))
+        # Initialize the Q-table with zeros, or with a table trained offline from recorded PID traces (see offline_q_training_code).
+        if q_table is None:
+            self.q_table = np.zeros((self.state_space_size, self.action_space_size))
+        else:
+            self.q_table = np.asarray(q_table, dtype=float).reshape(self.state_space_size, self.action_space_size).copy()
         # start the heatmap.
-        self.qdata = QDataHandler()
-        heatmap = HeatmapAnimator(num_states= self.state_space_size, num_actions=self.action_space_size)
-        heatmap.start_animation()
+        self.qdata = QDataHandler() if QDataHandler else None
+        if HeatmapAnimator:
+            heatmap = HeatmapAnimator(num_states= self.state_space_size, num_actions=self.action_space_size)
+            heatmap.start_animation()
     def decide_action(self, state):
         """Decide an action based on the current state using the epsilon-greedy policy.
 
@@ -63,7 +71,8 @@ class QLearningAgent:
         new_value = old_value + self.learning_rate * (reward + self.discount_rate * future_rewards - old_value)
 
         self.q_table[state, action] = new_value
-        self.qdata.put_q_data((state, action, new_value))
+        if self.qdata:
+            self.qdata.put_q_data((state, action, new_value))
         # Update the exploration rate if the episode is not done
         if not done:
             self.exploration_rate = max(self.min_exploration_rate, self.exploration_rate * self.exploration_decay)
@@ -0,0 +1,260 @@
+"""
+A shared-memory bus for decoded SnifferBuddy readings.  The ingest process is the one writer:  it decodes each datagram
+once and puts the reading in a ring of fixed size records.  Any number of local processes (PID workers, recorders,
+dashboards) map the same memory and read the records as NumPy views, so they neither bind UDP 8095 nor parse JSON.
+
+Layout of the shared memory:
+    header   magic, version, sizes, the number of names and `head`, the number of records written so far.
+    names    fixed slots holding the utf-8 location and sensor names.  Records refer to them by index.
+    records  `capacity` records of RECORD_DTYPE.  Record number n (counting from 1) lives in slot (n - 1) % capacity.
+
+Each record carries its sequence number.  The writer zeroes it, fills in the record, sets it and only then moves `head`
+on, so a reader never takes a half written record as valid.  Readers never block the writer:  one that falls more than
+`capacity` records behind skips ahead and counts what it missed in `lost`.
+
+Example:
+    python src/sensor_bus_code.py --port 8095            # ingest: receive the UDP readings and write them to the bus
+    python src/sensor_bus_code.py --read                 # any number of readers
+"""
+import argparse
+import asyncio
+from multiprocessing import shared_memory
+from typing import List, Optional
+
+import numpy as np
+
+from pydantic_models import SensorDataModel, SnifferBuddyModel
+from wire_format_code import FLOAT_FIELDS
+
+DEFAULT_BUS_NAME = "growbuddies_sensor_bus"
+MAGIC = b"SBUS"
+VERSION = 1
+NAME_BYTES = 64
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S4"), ("version", "<u4"), ("capacity", "<u8"), ("record_size", "<u4"), ("name_slots", "<u4"),
+    ("names_count", "<u4"), ("pad", "<u4"), ("head", "<u8"),
+], align=True)
+_PACKED_RECORD = np.dtype([
+    ("seq", "<u8"), ("timestamp", "<i8"), *((field, "<f4") for field in FLOAT_FIELDS),
+    ("location", "<u2"), ("name", "<u2"), ("light", "u1"),
+])
+# Padded to 48 bytes so records stay 8 byte aligned.
+RECORD_DTYPE = np.dtype({
+    "names": list(_PACKED_RECORD.names),
+    "formats": [_PACKED_RECORD.fields[field][0] for field in _PACKED_RECORD.names],
+    "offsets": [_PACKED_RECORD.fields[field][1] for field in _PACKED_RECORD.names],
+    "itemsize": 48,
+})
+
+
+def _layout(buffer, capacity: int, name_slots: int):
+    header = np.ndarray((), HEADER_DTYPE, buffer, 0)
+    names = np.ndarray((name_slots,), f"S{NAME_BYTES}", buffer, HEADER_DTYPE.itemsize)
+    records = np.ndarray((capacity,), RECORD_DTYPE, buffer, HEADER_DTYPE.itemsize + name_slots * NAME_BYTES)
+    return header, names, records
+
+
+class SensorBusWriter:
+    """
+    The single writer of a sensor bus.  Creates the shared memory.  A bus of the same name is only replaced when asked
+    to, since it may belong to an ingest process that is still running.
+    """
+    def __init__(self, name: str = DEFAULT_BUS_NAME, capacity: int = 8192, name_slots: int = 1024, replace: bool = False):
+        """
+        Args:
+            name (str): The shared memory name readers attach to.
+            capacity (int): Records in the ring.
+            name_slots (int): Location and sensor names the bus can hold.
+            replace (bool): Unlink a bus of the same name, e.g. one left behind by an ingest process that died.
+
+        Raises:
+            FileExistsError: If a bus of this name exists and replace is False.
+        """
+        size = HEADER_DTYPE.itemsize + name_slots * NAME_BYTES + capacity * RECORD_DTYPE.itemsize
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            if not replace:
+                raise FileExistsError(f"A sensor bus named {name} already exists.  Another ingest process may be writing "
+                                      f"to it.  Stop that one, or pass replace=True (--replace) if it died.") from None
+            # Readers of the old bus see its magic go away.
+            stale = shared_memory.SharedMemory(name)
+            stale.unlink()
+            stale.close()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self.header, self.names, self.records = _layout(self.shm.buf, capacity, name_slots)
+        self.capacity = capacity
+        self._ids = {}
+        self.header["magic"] = MAGIC
+        self.header["version"] = VERSION
+        self.header["capacity"] = capacity
+        self.header["record_size"] = RECORD_DTYPE.itemsize
+        self.header["name_slots"] = name_slots
+        self.header["names_count"] = 0
+        self.header["head"] = 0
+        self._head = 0
+
+    def _name_id(self, name: str) -> int:
+        name_id = self._ids.get(name)
+        if name_id is None:
+            name_id = len(self._ids)
+            if name_id == len(self.names):
+                raise ValueError("The sensor bus name table is full.")
+            encoded = name.encode("utf-8")
+            if len(encoded) > NAME_BYTES:
+                raise ValueError(f"{name} is longer than {NAME_BYTES} bytes.")
+            self.names[name_id] = encoded
+            # The name is in place before readers are told there is one more.
+            self.header["names_count"] = name_id + 1
+            self._ids[name] = name_id
+        return name_id
+
+    def publish(self, reading: SnifferBuddyModel) -> int:
+        """Add a reading to the bus.  Returns its sequence number."""
+        location = self._name_id(reading.tags.get("location", ""))
+        name = self._name_id(reading.tags.get("name", ""))
+        fields = reading.fields
+        seq = self._head + 1
+        slot = self._head % self.capacity
+        self.records["seq"][slot] = 0
+        self.records[slot] = (0, reading.timestamp, *(getattr(fields, field) for field in FLOAT_FIELDS), location, name, fields.light)
+        self.records["seq"][slot] = seq
+        self.header["head"] = seq
+        self._head = seq
+        return seq
+
+    def close(self, unlink: bool = True):
+        # The views have to go before the memory can be closed.
+        del self.header, self.names, self.records
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class SensorBusReader:
+    """
+    Maps a sensor bus and reads the records after its cursor.  read() returns views into the shared memory:  nothing is
+    copied, and a view stays good until the writer comes round the ring to it (see is_current()).  Copy what needs to be
+    kept longer.
+    """
+    def __init__(self, name: str = DEFAULT_BUS_NAME, from_start: bool = False):
+        """
+        Args:
+            name (str): The bus name the writer used.
+            from_start (bool): Start with the oldest record still in the ring instead of the next one written.
+        """
+        self.shm = _attach(name)
+        header = np.ndarray((), HEADER_DTYPE, self.shm.buf, 0)
+        if bytes(header["magic"]) != MAGIC or int(header["version"]) != VERSION:
+            raise ValueError(f"{name} is not a version {VERSION} sensor bus.")
+        self.capacity = int(header["capacity"])
+        self.header, self.names, self.records = _layout(self.shm.buf, self.capacity, int(header["name_slots"]))
+        head = int(self.header["head"])
+        self.cursor = max(0, head - self.capacity) if from_start else head
+        self.lost = 0
+        self._names: List[str] = []
+
+    def read(self, max_records: Optional[int] = None) -> np.ndarray:
+        """
+        The records written since the last read, as a view of RECORD_DTYPE.  When the unread records wrap round the end
+        of the ring, only the part up to the end is returned.  Call again for the rest.
+        """
+        head = int(self.header["head"])
+        if head - self.cursor > self.capacity:
+            # The writer lapped us.  Skip to the oldest record it hasn't overwritten.
+            self.lost += head - self.capacity - self.cursor
+            self.cursor = head - self.capacity
+        start = self.cursor % self.capacity
+        count = min(head - self.cursor, self.capacity - start)
+        if max_records is not None:
+            count = min(count, max_records)
+        view = self.records[start:start + count]
+        # A record the writer has started to overwrite since we read head no longer has the sequence number we expect.
+        current = view["seq"] == np.arange(self.cursor + 1, self.cursor + count + 1, dtype=np.uint64)
+        if not current.all():
+            count = int(np.argmin(current))
+            view = view[:count]
+        self.cursor += count
+        return view
+
+    def is_current(self, view: np.ndarray) -> bool:
+        """True if the writer has not yet started to overwrite any of the records in a view read()."""
+        if len(view) == 0:
+            return True
+        # The writer may be in the middle of the record after head, which lands in the slot of head + 1 - capacity.
+        return int(self.header["head"]) + 1 - self.capacity < int(view["seq"][0])
+
+    def name(self, name_id: int) -> str:
+        if name_id >= len(self._names):
+            count = int(self.header["names_count"])
+            self._names.extend(bytes(self.names[i]).decode("utf-8") for i in range(len(self._names), count))
+        return self._names[name_id]
+
+    def to_models(self, view: np.ndarray) -> List[SnifferBuddyModel]:
+        """Copy records out of the bus as SnifferBuddyModels, for code that wants the usual objects."""
+        models = []
+        for record in view:
+            fields = SensorDataModel.model_construct(light=int(record["light"]), **{field: float(record[field]) for field in FLOAT_FIELDS})
+            tags = {"location": self.name(int(record["location"])), "name": self.name(int(record["name"]))}
+            models.append(SnifferBuddyModel.model_construct(fields=fields, name="snifferbuddy", tags=tags, timestamp=int(record["timestamp"])))
+        return models
+
+    async def stream(self, poll_seconds: float = 0.1):
+        """Yield non-empty batches of new records as they come in."""
+        while True:
+            view = self.read()
+            if len(view):
+                yield view
+            else:
+                await asyncio.sleep(poll_seconds)
+
+    def close(self):
+        del self.header, self.names, self.records
+        self.shm.close()
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    # A reader must not unlink the writer's memory when it exits.  Before Python 3.13 the resource tracker does that to
+    # every SharedMemory it sees, so the reader takes it off the tracker's list.
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+async def run_ingest(name: str, port: int, host: str, replace: bool = False):
+    from logger_code import LoggerBase
+    from process_udp_code import UDPProcessor
+
+    writer = SensorBusWriter(name, replace=replace)
+    processor = UDPProcessor(LoggerBase.setup_logger('SensorBus'))
+    await processor.init_udp_listener(None, port, host, sensor_bus=writer)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        processor.close()
+        writer.close()
+
+
+async def run_reader(name: str):
+    reader = SensorBusReader(name)
+    async for view in reader.stream():
+        for model in reader.to_models(view):
+            print(model.model_dump_json())
+        if reader.lost:
+            print(f"lost {reader.lost} readings")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write UDP SnifferBuddy readings to a shared-memory bus, or read them from it.")
+    parser.add_argument("--name", default=DEFAULT_BUS_NAME)
+    parser.add_argument("--port", type=int, default=8095)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--read", action="store_true", help="Print the readings on the bus instead of writing them.")
+    parser.add_argument("--replace", action="store_true", help="Replace a bus of the same name left behind by an ingest process that died.")
+    args = parser.parse_args()
+    asyncio.run(run_reader(args.name) if args.read else run_ingest(args.name, args.port, args.host, args.replace))
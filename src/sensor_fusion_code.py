@@ -0,0 +1,83 @@
+from typing import Dict, Optional
+
+import numpy as np
+
+from pydantic_models import SensorDataModel, SnifferBuddyModel
+from wire_format_code import FLOAT_FIELDS
+
+FUSED_SENSOR_NAME = "fused"
+# The spread below which sensors are never called outliers, whatever the MAD says.  Two good sensors a few ppm apart
+# would otherwise make the third look wrong.
+MIN_SPREAD = {"CO2": 50.0, "dewpoint": 0.5, "eCO2": 50.0, "humidity": 3.0, "temperature": 0.5, "vpd": 0.1}
+
+
+class SensorFusion:
+    """
+    Fuses the SnifferBuddies in one tent into one reading per control tick.  The latest reading of each sensor is kept
+    in a row of a fixed (sensors, fields) array.  When a tick is due, sensors that have not reported within
+    `stale_seconds` are left out, and for each field the values further than `outlier_mads` scaled MADs from the
+    median are left out too.  The fused value is the mean of what is left.
+
+    With one sensor this passes its readings through at most once a tick.  With two, the median can't tell which one is
+    off, so they are averaged.  Three or more are needed for outliers to be caught.
+    """
+    def __init__(self, tent_name: str, tick_seconds: float = 10, stale_seconds: float = 60, outlier_mads: float = 3.0,
+                 max_sensors: int = 8):
+        self.tent_name = tent_name
+        self.tick_seconds = tick_seconds
+        self.stale_seconds = stale_seconds
+        self.outlier_mads = outlier_mads
+        self._rows: Dict[str, int] = {}
+        self._values = np.full((max_sensors, len(FLOAT_FIELDS)), np.nan)
+        self._lights = np.zeros(max_sensors)
+        self._timestamps = np.zeros(max_sensors, dtype=np.int64)
+        self._min_spread = np.array([MIN_SPREAD[field] for field in FLOAT_FIELDS])
+        self._last_tick: Optional[int] = None
+        self.stale = 0
+        self.outliers = 0
+
+    def _row(self, name: str) -> int:
+        row = self._rows.get(name)
+        if row is None:
+            if len(self._rows) < len(self._timestamps):
+                row = len(self._rows)
+            else:
+                # Full.  The sensor that has been quiet the longest makes room.
+                row = int(np.argmin(self._timestamps))
+                self._rows = {sensor: r for sensor, r in self._rows.items() if r != row}
+            self._rows[name] = row
+        return row
+
+    def update(self, reading: SnifferBuddyModel) -> Optional[SnifferBuddyModel]:
+        """
+        Record a reading from one of the tent's sensors.
+
+        Returns:
+            SnifferBuddyModel: The fused reading if a control tick is due, otherwise None.
+        """
+        row = self._row(reading.tags.get("name", ""))
+        fields = reading.fields
+        self._values[row] = [getattr(fields, field) for field in FLOAT_FIELDS]
+        self._lights[row] = fields.light
+        self._timestamps[row] = reading.timestamp
+        if self._last_tick is not None and reading.timestamp < self._last_tick + self.tick_seconds:
+            return None
+        self._last_tick = reading.timestamp
+        return self._fuse(reading.timestamp)
+
+    def _fuse(self, now: int) -> SnifferBuddyModel:
+        fresh = now - self._timestamps <= self.stale_seconds
+        self.stale += int(len(self._rows) - fresh.sum())
+        values = self._values[fresh]
+        median = np.median(values, axis=0)
+        deviation = np.abs(values - median)
+        # 1.4826 * MAD estimates the standard deviation for normally distributed readings.
+        spread = np.maximum(1.4826 * np.median(deviation, axis=0), self._min_spread)
+        inliers = deviation <= self.outlier_mads * spread
+        self.outliers += int(inliers.size - inliers.sum())
+        fused = np.sum(np.where(inliers, values, 0.0), axis=0) / inliers.sum(axis=0)
+        # The light is on if most of the fresh sensors see it on.  A tie counts as on.
+        light = int(self._lights[fresh].mean() >= 0.5)
+        fields = SensorDataModel.model_construct(light=light, **{field: float(value) for field, value in zip(FLOAT_FIELDS, fused)})
+        return SnifferBuddyModel.model_construct(fields=fields, name="snifferbuddy",
+                                                 tags={"location": self.tent_name, "name": FUSED_SENSOR_NAME}, timestamp=now)
@@ -0,0 +1,258 @@
+from bisect import bisect_right
+from collections import OrderedDict
+import os
+import re
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from logger_code import LoggerBase
+from pydantic_models import SnifferBuddyModel
+
+# The columns kept for each reading and their on-disk types.  float32 is plenty for what the SnifferBuddy measures.
+COLUMNS = {
+    "timestamp": np.int64,
+    "CO2": np.float32,
+    "vpd": np.float32,
+    "temperature": np.float32,
+    "humidity": np.float32,
+    "light": np.uint8,
+}
+SEGMENT_ROWS = 8640  # One day of readings every 10 seconds.
+FLUSH_SECONDS = 300  # How much reading time the segment being filled can get ahead of what is on disk.
+OPEN_SEGMENTS = 4  # How many on-disk segments stay memory mapped at once.
+_SEGMENT_FILE = re.compile(r"segment_(\d{6})\.timestamp\.npy$")
+
+
+class SensorHistoryStore:
+    """
+    Keeps the sensor history of one grow tent as typed columns.  New readings go into a fixed size in-memory segment.
+    When it fills up it is written out as one .npy file per column and later read back memory mapped, so weeks of
+    readings can be queried while only the current segment and a few mapped segments take up RAM.
+
+    The segment being filled is also written out, over its previous copy, every `flush_seconds` of readings and on
+    close(), and picked up again when the store is reopened.  A restart loses at most `flush_seconds` of readings.
+
+    Readings need to arrive in timestamp order (the jitter buffer in front of the controllers takes care of this).  A
+    reading older than the newest one stored is dropped and logged.
+    """
+    _stores: Dict[str, "SensorHistoryStore"] = {}
+
+    @classmethod
+    def open(cls, tent_name: str, directory: str, segment_rows: int = SEGMENT_ROWS, flush_seconds: float = FLUSH_SECONDS) -> "SensorHistoryStore":
+        """Return the store for a tent.  The CO2 and VPD environments of a tent share one store."""
+        path = os.path.join(directory, tent_name)
+        if path not in cls._stores:
+            cls._stores[path] = cls(tent_name, directory, segment_rows, flush_seconds)
+        return cls._stores[path]
+
+    def __init__(self, tent_name: str, directory: str, segment_rows: int = SEGMENT_ROWS, flush_seconds: float = FLUSH_SECONDS):
+        self.logger = LoggerBase.setup_logger('SensorHistory')
+        self.tent_name = tent_name
+        self.path = os.path.join(directory, tent_name)
+        os.makedirs(self.path, exist_ok=True)
+        self.segment_rows = segment_rows
+        self.flush_seconds = flush_seconds
+        self._active = {name: np.empty(segment_rows, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self._active_rows = 0
+        # The segment number the active readings are written out under.
+        self._active_number = 0
+        # The newest timestamp written out with the active segment.
+        self._flushed_timestamp: Optional[int] = None
+        # One entry per on-disk segment, oldest first: segment number, first timestamp, last timestamp, rows.
+        self._segments: List[tuple] = []
+        self._segment_starts: List[int] = []
+        self._mapped: "OrderedDict[int, Dict[str, np.ndarray]]" = OrderedDict()
+        self._last_timestamp: Optional[int] = None
+        # The sensor names already stored for the newest timestamp.  Lets two environments of the same tent share the store without writing a reading twice.
+        self._last_names = set()
+        self._load_index()
+
+    def _load_index(self):
+        numbers = sorted(int(m.group(1)) for m in map(_SEGMENT_FILE.match, os.listdir(self.path)) if m)
+        for number in numbers:
+            timestamps = self._segment(number)["timestamp"]
+            if len(timestamps):
+                self._add_to_index(number, int(timestamps[0]), int(timestamps[-1]), len(timestamps))
+        if self._segments:
+            self._last_timestamp = self._segments[-1][2]
+            number, _, _, rows = self._segments[-1]
+            self._active_number = number + 1
+            if rows < self.segment_rows:
+                # The segment that was being filled when the store was last flushed.  Carry on filling it.
+                segment = self._segment(number)
+                for name in COLUMNS:
+                    self._active[name][:rows] = segment[name]
+                # flush() replaces its files, so it must not stay mapped.
+                del self._mapped[number]
+                self._active_rows = rows
+                self._active_number = number
+                self._flushed_timestamp = self._last_timestamp
+                self._segments.pop()
+                self._segment_starts.pop()
+
+    def _add_to_index(self, number: int, first: int, last: int, rows: int):
+        self._segments.append((number, first, last, rows))
+        self._segment_starts.append(first)
+
+    def _segment_file(self, number: int, column: str) -> str:
+        return os.path.join(self.path, f"segment_{number:06d}.{column}.npy")
+
+    def _segment(self, number: int) -> Dict[str, np.ndarray]:
+        if number in self._mapped:
+            self._mapped.move_to_end(number)
+            return self._mapped[number]
+        columns = {name: np.load(self._segment_file(number, name), mmap_mode='r') for name in COLUMNS}
+        self._mapped[number] = columns
+        if len(self._mapped) > OPEN_SEGMENTS:
+            self._mapped.popitem(last=False)
+        return columns
+
+    def __len__(self) -> int:
+        return sum(segment[3] for segment in self._segments) + self._active_rows
+
+    def append(self, timestamp: int, CO2: float, vpd: float, temperature: float, humidity: float, light: int, sensor_name: str = "") -> bool:
+        """
+        Add one reading.
+
+        Returns:
+            bool: False if the reading was dropped because it is older than the newest stored reading or was already stored.
+        """
+        if self._last_timestamp is not None:
+            if timestamp < self._last_timestamp:
+                self.logger.warning(f"Dropping {self.tent_name} reading at {timestamp}.  It is older than the newest stored reading at {self._last_timestamp}.")
+                return False
+            if timestamp == self._last_timestamp and sensor_name in self._last_names:
+                return False
+            if timestamp > self._last_timestamp:
+                self._last_names.clear()
+        self._last_timestamp = timestamp
+        self._last_names.add(sensor_name)
+        row = self._active_rows
+        self._active["timestamp"][row] = timestamp
+        self._active["CO2"][row] = CO2
+        self._active["vpd"][row] = vpd
+        self._active["temperature"][row] = temperature
+        self._active["humidity"][row] = humidity
+        self._active["light"][row] = light
+        self._active_rows += 1
+        self._written()
+        return True
+
+    def append_reading(self, reading: SnifferBuddyModel) -> bool:
+        fields = reading.fields
+        return self.append(reading.timestamp, fields.CO2, fields.vpd, fields.temperature, fields.humidity, fields.light, reading.tags.get("name", ""))
+
+    def append_batch(self, columns: Dict[str, np.ndarray]) -> int:
+        """
+        Add many readings at once, e.g. from the backfill importer.  The batch is sorted by timestamp and the rows that
+        are not newer than what is already stored are dropped, with a warning saying how many.  To backfill history
+        older than what a live store holds, import it into a new directory.
+
+        Returns:
+            int: The number of rows added.
+        """
+        order = np.argsort(columns["timestamp"], kind="stable")
+        batch = {name: np.asarray(columns[name])[order].astype(dtype, copy=False) for name, dtype in COLUMNS.items()}
+        if self._last_timestamp is not None:
+            keep = batch["timestamp"] > self._last_timestamp
+            rejected = len(keep) - int(keep.sum())
+            if rejected:
+                self.logger.warning(f"Dropped {rejected} of {len(keep)} {self.tent_name} rows that are not newer than the newest stored reading at {self._last_timestamp}.")
+            batch = {name: values[keep] for name, values in batch.items()}
+        total = len(batch["timestamp"])
+        start = 0
+        while start < total:
+            take = min(self.segment_rows - self._active_rows, total - start)
+            for name in COLUMNS:
+                self._active[name][self._active_rows:self._active_rows + take] = batch[name][start:start + take]
+            self._active_rows += take
+            start += take
+            self._last_timestamp = int(batch["timestamp"][start - 1])
+            self._written()
+        if total:
+            self._last_names.clear()
+        return total
+
+    def _written(self):
+        if self._active_rows == self.segment_rows:
+            self._seal()
+        elif self._flushed_timestamp is None or self._last_timestamp - self._flushed_timestamp >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """Write the readings of the segment being filled out to disk, over the last copy of it."""
+        if self._active_rows == 0:
+            return
+        rows = self._active_rows
+        for name in COLUMNS:
+            # Write next to the old copy and swap it in, so a crash mid-write leaves the old copy whole.
+            final = self._segment_file(self._active_number, name)
+            partial = final[:-len(".npy")] + ".partial.npy"
+            np.save(partial, self._active[name][:rows])
+            os.replace(partial, final)
+        self._flushed_timestamp = int(self._active["timestamp"][rows - 1])
+
+    def _seal(self):
+        """Write out the full active segment and start a new one."""
+        self.flush()
+        rows = self._active_rows
+        timestamps = self._active["timestamp"]
+        self._add_to_index(self._active_number, int(timestamps[0]), int(timestamps[rows - 1]), rows)
+        self.logger.debug(f"Wrote segment {self._active_number} with {rows} readings for {self.tent_name}.")
+        self._active_number += 1
+        self._active_rows = 0
+        self._flushed_timestamp = None
+
+    def close(self):
+        """Flush, and let the next open() of this tent start from what is on disk."""
+        self.flush()
+        self._mapped.clear()
+        SensorHistoryStore._stores.pop(self.path, None)
+
+    def range(self, start: int, end: int, columns: Optional[Sequence[str]] = None) -> Dict[str, np.ndarray]:
+        """
+        The readings with start <= timestamp < end.
+
+        Args:
+            start (int): First timestamp (seconds since the epoch) to include.
+            end (int): Timestamp to stop before.
+            columns (list, optional): The columns to return.  Defaults to all of them.
+
+        Returns:
+            dict: Column name to numpy array.
+        """
+        columns = list(columns or COLUMNS)
+        pieces = {name: [] for name in columns}
+        # Skip the segments that end before start.  Segments are in time order so the search can start at the last one that begins at or before start.
+        first = max(bisect_right(self._segment_starts, start) - 1, 0)
+        for number, first_ts, last_ts, _ in self._segments[first:]:
+            if first_ts >= end:
+                break
+            if last_ts < start:
+                continue
+            segment = self._segment(number)
+            lo, hi = np.searchsorted(segment["timestamp"], [start, end])
+            for name in columns:
+                pieces[name].append(segment[name][lo:hi])
+        timestamps = self._active["timestamp"][:self._active_rows]
+        lo, hi = np.searchsorted(timestamps, [start, end])
+        for name in columns:
+            pieces[name].append(self._active[name][lo:hi])
+        return {name: np.concatenate(pieces[name]) for name in columns}
+
+    def last(self, n: int, columns: Optional[Sequence[str]] = None) -> Dict[str, np.ndarray]:
+        """The newest n readings, oldest first."""
+        columns = list(columns or COLUMNS)
+        take = min(n, self._active_rows)
+        pieces = {name: [self._active[name][self._active_rows - take:self._active_rows]] for name in columns}
+        remaining = n - take
+        for number, _, _, rows in reversed(self._segments):
+            if remaining <= 0:
+                break
+            segment = self._segment(number)
+            take = min(remaining, rows)
+            for name in columns:
+                pieces[name].insert(0, segment[name][rows - take:])
+            remaining -= take
+        return {name: np.concatenate(pieces[name]) for name in columns}
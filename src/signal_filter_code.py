@@ -0,0 +1,192 @@
+from bisect import bisect_left, insort
+from typing import List, Optional
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import lfilter
+
+from pydantic_models import SignalFilterModel
+
+
+class RingBuffer:
+    """A fixed size buffer of the most recent values.  Pushing onto a full buffer evicts the oldest value."""
+    def __init__(self, size: int):
+        self.size = size
+        self._values: List[float] = [0.0] * size
+        self._next = 0
+        self.count = 0
+
+    def push(self, value: float) -> Optional[float]:
+        """Add a value.  Returns the value that was evicted or None if the buffer was not full yet."""
+        evicted = self._values[self._next] if self.count == self.size else None
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        return evicted
+
+    def values(self) -> List[float]:
+        """The values in the buffer, oldest first."""
+        if self.count < self.size:
+            return self._values[:self.count]
+        return self._values[self._next:] + self._values[:self._next]
+
+
+class RunningMean:
+    """The mean of the last `window` values, kept up to date with a running sum."""
+    def __init__(self, window: int):
+        self.window = window
+        self._ring = RingBuffer(window)
+        self._total = 0.0
+        self._updates = 0
+
+    def __call__(self, value: float) -> float:
+        evicted = self._ring.push(value)
+        self._total += value - (evicted if evicted is not None else 0.0)
+        # Re-sum once per window so floating point drift in the running sum can't build up.  This is still O(1) per sample on average.
+        self._updates += 1
+        if self._updates >= self.window:
+            self._updates = 0
+            self._total = sum(self._ring.values())
+        return self._total / self._ring.count
+
+    def filter_array(self, values: np.ndarray) -> np.ndarray:
+        cumulative = np.concatenate(([0.0], np.cumsum(values, dtype=float)))
+        index = np.arange(1, len(values) + 1)
+        start = np.maximum(index - self.window, 0)
+        return (cumulative[index] - cumulative[start]) / (index - start)
+
+
+class ExponentialMovingAverage:
+    """An EMA.  alpha closer to 1 follows the readings more closely, closer to 0 smooths more."""
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self._value: Optional[float] = None
+
+    def __call__(self, value: float) -> float:
+        if self._value is None:
+            self._value = value
+        else:
+            self._value = self.alpha * value + (1 - self.alpha) * self._value
+        return self._value
+
+    def filter_array(self, values: np.ndarray) -> np.ndarray:
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return values
+        # y[n] = alpha * x[n] + (1 - alpha) * y[n-1], seeded so that y[0] = x[0].
+        filtered, _ = lfilter([self.alpha], [1, self.alpha - 1], values, zi=[(1 - self.alpha) * values[0]])
+        return filtered
+
+
+class RollingMedian:
+    """
+    The median of the last `window` values.  A sorted copy of the window is kept next to the ring buffer, so each sample
+    costs a binary search plus a shift of at most `window` entries - constant for the small windows we use.
+    """
+    def __init__(self, window: int):
+        self.window = window
+        self._ring = RingBuffer(window)
+        self._sorted: List[float] = []
+
+    def __call__(self, value: float) -> float:
+        evicted = self._ring.push(value)
+        if evicted is not None:
+            del self._sorted[bisect_left(self._sorted, evicted)]
+        insort(self._sorted, value)
+        n = len(self._sorted)
+        middle = n // 2
+        if n % 2:
+            return self._sorted[middle]
+        return (self._sorted[middle - 1] + self._sorted[middle]) / 2
+
+    def filter_array(self, values: np.ndarray) -> np.ndarray:
+        values = np.asarray(values, dtype=float)
+        filtered = np.empty_like(values)
+        warmup = min(self.window - 1, len(values))
+        # Until the window fills up, the median is over the values seen so far.
+        for i in range(warmup):
+            filtered[i] = np.median(values[:i + 1])
+        if len(values) >= self.window:
+            filtered[warmup:] = np.median(sliding_window_view(values, self.window), axis=1)
+        return filtered
+
+
+class OutlierRejector:
+    """
+    Replaces a reading with the window mean when it is more than `sigma` standard deviations from the mean of the
+    previous `window` raw readings.  The statistics come from a running sum and sum of squares.  The raw readings
+    (outliers included) make up the window, so a real step change is accepted once the window catches up to it.
+    """
+    MIN_SAMPLES = 3
+
+    def __init__(self, window: int, sigma: float):
+        self.window = window
+        self.sigma = sigma
+        self._ring = RingBuffer(window)
+        self._total = 0.0
+        self._total_squares = 0.0
+
+    def __call__(self, value: float) -> float:
+        output = value
+        count = self._ring.count
+        if count >= self.MIN_SAMPLES:
+            mean = self._total / count
+            variance = max(self._total_squares / count - mean * mean, 0.0)
+            if abs(value - mean) > self.sigma * variance ** 0.5 and variance > 0:
+                output = mean
+        evicted = self._ring.push(value)
+        self._total += value
+        self._total_squares += value * value
+        if evicted is not None:
+            self._total -= evicted
+            self._total_squares -= evicted * evicted
+        return output
+
+    def filter_array(self, values: np.ndarray) -> np.ndarray:
+        values = np.asarray(values, dtype=float)
+        cumulative = np.concatenate(([0.0], np.cumsum(values)))
+        cumulative_squares = np.concatenate(([0.0], np.cumsum(values * values)))
+        # The window for sample i is the raw values[i - window:i].
+        index = np.arange(len(values))
+        start = np.maximum(index - self.window, 0)
+        count = index - start
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = (cumulative[index] - cumulative[start]) / count
+            variance = np.maximum((cumulative_squares[index] - cumulative_squares[start]) / count - mean * mean, 0.0)
+        outlier = (count >= self.MIN_SAMPLES) & (variance > 0) & (np.abs(values - mean) > self.sigma * np.sqrt(variance))
+        return np.where(outlier, mean, values)
+
+
+class SignalConditioner:
+    """
+    Conditions the readings before they get to the PID controller:  outlier rejection (if configured) followed by one
+    smoothing filter.  Call it with one reading at a time, or use filter_array() to run a whole recorded series through a
+    fresh copy of the same filters (this does not touch the streaming state).
+    """
+    def __init__(self, config: SignalFilterModel):
+        self.config = config
+        self._stages = self._build_stages()
+
+    def _build_stages(self) -> list:
+        stages = []
+        if self.config.outlier_sigma:
+            stages.append(OutlierRejector(self.config.window, self.config.outlier_sigma))
+        kind = self.config.kind.lower()
+        if kind == "mean":
+            stages.append(RunningMean(self.config.window))
+        elif kind == "ema":
+            stages.append(ExponentialMovingAverage(self.config.alpha))
+        elif kind == "median":
+            stages.append(RollingMedian(self.config.window))
+        return stages
+
+    def __call__(self, value: float) -> float:
+        for stage in self._stages:
+            value = stage(value)
+        return value
+
+    def filter_array(self, values) -> np.ndarray:
+        filtered = np.asarray(values, dtype=float)
+        for stage in self._build_stages():
+            filtered = stage.filter_array(filtered)
+        return filtered
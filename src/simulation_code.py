@@ -0,0 +1,457 @@
+"""
+Discrete-event simulation of the whole pipeline.  The real SimpleUDPServer -> GrowTentEnv -> PID_Controller ->
+ActuationScheduler -> async_publish_single chain runs on an event loop whose clock is virtual:  when nothing is ready to
+run, the loop jumps straight to its next timer instead of sleeping.  A day of traffic from several tents, with the
+wait_for timeouts, the retry sleeps and the PulseTime durations, takes seconds, and a given seed always gives the same
+result.
+
+What is simulated:
+    the network     datagrams go from transport to protocol after a small random latency, and some can be dropped.
+    the sensors     one SnifferBuddy per tent sends a reading every 10 seconds, as telegraf would forward it.
+    the tents       CO2 and humidity drift with the light and the plants, and rise while their plug is on.
+    the broker      publish.single calls fail now and then, or hang past the timeout, and fail outright during outages.
+    the plugs       Tasmota relays that turn off PulseTime after turning on.
+
+Example:
+    python src/simulation_code.py --tents 3 --days 1 --seed 0
+"""
+import argparse
+import asyncio
+import errno
+import functools
+import hashlib
+import logging
+import math
+import random
+import selectors
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from actuation_scheduler_code import ActuationScheduler
+from growtent_env_code import GrowTentEnv
+from logger_code import LoggerBase
+from mqtt_code import async_publish_single
+from mqtt_ingest_code import calc_vpd
+from process_udp_code import UDPProcessor
+from pydantic_models import GlobalConfig, GrowTentParams, MonitorParam, SensorDataModel, SnifferBuddyModel
+from soak_test_code import soak_config
+
+# Midnight UTC, so the light cycle of the simulated day starts with the light coming on.
+START_TIMESTAMP = 1699920000
+READING_SECONDS = 10
+LIGHT_ON_HOURS = 18
+SNIFFERBUDDY_PORT = 8095
+
+
+class SimulationStalled(RuntimeError):
+    """Nothing is left to run and no timer is set, so the simulation can never move on."""
+
+
+class _VirtualSelector(selectors.BaseSelector):
+    """
+    Wraps the real selector so the loop's own self-pipe still works, but never blocks:  when the loop would wait for
+    `timeout` seconds, the virtual clock moves on by `timeout` instead.
+    """
+    def __init__(self, loop: "SimulatedEventLoop"):
+        self._loop = loop
+        self._selector = selectors.DefaultSelector()
+
+    def register(self, fileobj, events, data=None):
+        return self._selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._selector.modify(fileobj, events, data)
+
+    def get_map(self):
+        return self._selector.get_map()
+
+    def close(self):
+        self._selector.close()
+
+    def select(self, timeout=None):
+        ready = self._selector.select(0)
+        if ready or timeout == 0:
+            return ready
+        if timeout is None:
+            raise SimulationStalled("Every task is waiting and no timer is set.")
+        self._loop.advance(timeout)
+        return []
+
+
+class _SimulatedDatagramTransport(asyncio.DatagramTransport):
+    def __init__(self, loop: "SimulatedEventLoop", protocol: asyncio.DatagramProtocol, local_addr: Tuple[str, int],
+                 remote_addr: Optional[Tuple[str, int]]):
+        super().__init__()
+        self._loop = loop
+        self._protocol = protocol
+        self._local_addr = local_addr
+        self._remote_addr = remote_addr
+        self._closing = False
+
+    def get_extra_info(self, name, default=None):
+        if name == "sockname":
+            return self._local_addr
+        if name == "peername":
+            return self._remote_addr
+        return default
+
+    def sendto(self, data, addr=None):
+        self._loop.deliver(bytes(data), self._local_addr, addr or self._remote_addr)
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.unbind(self._local_addr[1], self._protocol)
+        self._loop.call_soon(self._protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+
+class SimulatedEventLoop(asyncio.SelectorEventLoop):
+    """
+    An asyncio event loop on a virtual clock.  Timers, sleeps and timeouts all work as usual, they just don't take any
+    real time.  UDP endpoints are simulated in the loop and run_in_executor() runs the function straight away but
+    only hands back its result after a simulated latency, so executor work can time out like it would for real.
+    """
+    def __init__(self, seed: int = 0, network_latency: Callable[[random.Random], float] = lambda rng: rng.uniform(0.001, 0.005),
+                 network_loss: float = 0.0, executor_latency: Callable[[random.Random], float] = lambda rng: 0.0):
+        """
+        Args:
+            seed (int): Seeds the network and executor randomness.
+            network_latency (Callable): Seconds a datagram takes, given the loop's random generator.
+            network_loss (float): Fraction of datagrams lost.
+            executor_latency (Callable): Seconds run_in_executor() takes to hand back a result, given the random generator.
+        """
+        self._now = 0.0
+        super().__init__(_VirtualSelector(self))
+        self.random = random.Random(seed)
+        self.network_latency = network_latency
+        self.network_loss = network_loss
+        self.executor_latency = executor_latency
+        self._bound: Dict[int, asyncio.DatagramProtocol] = {}
+        self._next_port = 40000
+        self.datagrams_sent = 0
+        self.datagrams_lost = 0
+
+    def time(self) -> float:
+        return self._now
+
+    def advance(self, seconds: float):
+        self._now += seconds
+
+    def run_in_executor(self, executor, func, *args):
+        future = self.create_future()
+        try:
+            result, error = func(*args), None
+        except Exception as e:
+            result, error = None, e
+
+        def done():
+            # wait_for cancels the future when it times out.
+            if future.cancelled():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        self.call_later(self.executor_latency(self.random), done)
+        return future
+
+    async def create_datagram_endpoint(self, protocol_factory, local_addr=None, remote_addr=None, **kwargs):
+        if local_addr is None:
+            self._next_port += 1
+            local_addr = ("127.0.0.1", self._next_port)
+        elif local_addr[1] in self._bound:
+            # One socket per port, as the real loop gives without SO_REUSEPORT.
+            raise OSError(errno.EADDRINUSE, f"Address already in use: {local_addr}")
+        protocol = protocol_factory()
+        self._bound[local_addr[1]] = protocol
+        transport = _SimulatedDatagramTransport(self, protocol, local_addr, remote_addr)
+        self.call_soon(protocol.connection_made, transport)
+        return transport, protocol
+
+    def unbind(self, port: int, protocol: asyncio.DatagramProtocol):
+        if self._bound.get(port) is protocol:
+            del self._bound[port]
+
+    def deliver(self, data: bytes, sender: Tuple[str, int], addr: Tuple[str, int]):
+        self.datagrams_sent += 1
+        if self.random.random() < self.network_loss:
+            self.datagrams_lost += 1
+            return
+        protocol = self._bound.get(addr[1])
+        if protocol is not None:
+            self.call_later(self.network_latency(self.random), protocol.datagram_received, data, sender)
+
+
+class SimulatedPlug:
+    """
+    A Tasmota relay as GrowTentEnv drives it:  Power 1 turns it on, and the PulseTime it was last sent turns it off
+    again that long after (0.1 second units up to 111, seconds + 100 above that, 0 for no limit).  A PulseTime that
+    comes in while the relay is on restarts the countdown from then.
+    """
+    def __init__(self):
+        self.pulse_seconds = 0.0
+        self._on_since: Optional[float] = None
+        self._off_at = math.inf
+        self._completed = 0.0
+        self.power_on_commands = 0
+
+    @staticmethod
+    def pulse_time_to_seconds(pulse_time: float) -> float:
+        if pulse_time <= 111:
+            return pulse_time / 10
+        return pulse_time - 100
+
+    def _fold(self, now: float):
+        if self._on_since is not None:
+            self._completed += max(0.0, min(now, self._off_at) - self._on_since)
+            self._on_since = None
+
+    def command(self, name: str, payload, now: float):
+        if name == "POWER":
+            if str(payload) in ("1", "ON", "on"):
+                self.power_on_commands += 1
+                self._fold(now)
+                self._on_since = now
+                self._off_at = now + self.pulse_seconds if self.pulse_seconds else math.inf
+            else:
+                self._fold(now)
+        elif name == "PulseTime":
+            self.pulse_seconds = self.pulse_time_to_seconds(float(payload))
+            if self.is_on(now):
+                self._completed += now - self._on_since
+                self._on_since = now
+                self._off_at = now + self.pulse_seconds if self.pulse_seconds else math.inf
+
+    def is_on(self, now: float) -> bool:
+        return self._on_since is not None and now < self._off_at
+
+    def on_seconds(self, now: float) -> float:
+        """Total seconds the relay has been on up to now."""
+        current = max(0.0, min(now, self._off_at) - self._on_since) if self._on_since is not None else 0.0
+        return self._completed + current
+
+
+class SimulatedBroker:
+    """
+    Stands in for paho's publish.single and routes cmnd/<device>/<command> messages to the simulated plugs.  Calls fail
+    with a refused connection at random or during an outage, and some hang for `hang_seconds` so the caller times out.
+    Since a hung publish still went out, the retry after the timeout sends the command again, as it would for real.
+    """
+    def __init__(self, loop: SimulatedEventLoop, failure_rate: float = 0.01, hang_rate: float = 0.002, hang_seconds: float = 90,
+                 outages: Optional[List[Tuple[float, float]]] = None):
+        self.loop = loop
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.outages = outages or []
+        self.plugs: Dict[str, SimulatedPlug] = {}
+        self.calls = 0
+        self.failures = 0
+        self.hangs = 0
+        # (virtual time, topic, payload) of every message that got through, for checking that runs are the same.
+        self.log: List[Tuple[float, str, str]] = []
+        # The latency of the call being made, picked up by the loop's executor_latency.
+        self._latency = 0.0
+
+    def plug(self, device: str) -> SimulatedPlug:
+        return self.plugs.setdefault(device, SimulatedPlug())
+
+    def latency(self, rng: random.Random) -> float:
+        return self._latency
+
+    def publish_single(self, topic, payload=None, hostname="localhost", qos=0, **kwargs):
+        now = self.loop.time()
+        self.calls += 1
+        rng = self.loop.random
+        self._latency = rng.uniform(0.01, 0.05)
+        if any(start <= now < end for start, end in self.outages) or rng.random() < self.failure_rate:
+            self.failures += 1
+            raise ConnectionRefusedError(f"Simulated broker {hostname} refused the connection.")
+        if rng.random() < self.hang_rate:
+            self.hangs += 1
+            self._latency = self.hang_seconds
+        self.log.append((now, topic, str(payload)))
+        device, name = topic.rsplit("/", 1)
+        self.plug(device).command(name, payload, now)
+
+
+class SimulatedTent:
+    """
+    How the air in a tent changes, stepped at each reading.  While the light is on the plants draw CO2 down and the
+    lamp dries the air.  The CO2 plug adds CO2 and the mister adds humidity for as long as they are on.
+    """
+    def __init__(self, name: str, broker: SimulatedBroker, rng: random.Random):
+        self.name = name
+        self.rng = rng
+        self.co2 = 900.0
+        self.humidity = 60.0
+        self.temperature = 24.0
+        self.co2_plug = broker.plug(f"cmnd/{name}_co2buddy")
+        self.mist_plug = broker.plug(f"cmnd/{name}_mistbuddy")
+        self._co2_on = 0.0
+        self._mist_on = 0.0
+
+    def step(self, now: float, dt: float, light: int) -> SensorDataModel:
+        co2_on = self.co2_plug.on_seconds(now) - self._co2_on
+        mist_on = self.mist_plug.on_seconds(now) - self._mist_on
+        self._co2_on += co2_on
+        self._mist_on += mist_on
+        # Leaks towards room air, the plants take up CO2 in the light and the CO2 plug adds about 5 ppm a second.
+        self.co2 += -0.001 * (self.co2 - 420) * dt - 0.3 * light * dt + 5.0 * co2_on + self.rng.gauss(0, 3)
+        self.humidity += -0.002 * (self.humidity - (45 if light else 55)) * dt + 0.1 * mist_on + self.rng.gauss(0, 0.2)
+        self.humidity = min(max(self.humidity, 5.0), 99.0)
+        self.temperature += 0.005 * ((27.0 if light else 21.0) - self.temperature) * dt + self.rng.gauss(0, 0.05)
+        return SensorDataModel(
+            CO2=round(self.co2), dewpoint=round(self.temperature - (100 - self.humidity) / 5, 1), eCO2=round(self.co2),
+            humidity=round(self.humidity, 1), light=light, temperature=round(self.temperature, 1),
+            vpd=calc_vpd(self.temperature, self.humidity),
+        )
+
+
+class Simulation:
+    def __init__(self, tent_names: List[str], days: float = 1, seed: int = 0, broker_failure_rate: float = 0.01,
+                 broker_hang_rate: float = 0.002, outages: Optional[List[Tuple[float, float]]] = None, network_loss: float = 0.0):
+        """
+        Args:
+            tent_names (list): One simulated tent, SnifferBuddy and pair of plugs per name.
+            days (float): Simulated days to run.
+            seed (int): Seed for everything random.  The same seed gives the same run.
+            broker_failure_rate (float): Fraction of publishes refused.
+            broker_hang_rate (float): Fraction of publishes that hang past the 60 second timeout.
+            outages (list): (start, end) seconds into the run during which the broker refuses everything.
+            network_loss (float): Fraction of UDP datagrams lost.
+        """
+        self.logger = LoggerBase.setup_logger('Simulation')
+        self.tent_names = tent_names
+        self.days = days
+        self.seed = seed
+        self.loop = SimulatedEventLoop(seed, network_loss=network_loss)
+        self.broker = SimulatedBroker(self.loop, broker_failure_rate, broker_hang_rate, outages=outages)
+        self.loop.executor_latency = self.broker.latency
+        self.random = random.Random(seed + 1)
+        self.tents = {name: SimulatedTent(name, self.broker, random.Random(f"{seed}:{name}")) for name in tent_names}
+        self.envs: List[GrowTentEnv] = []
+        self.readings_sent = 0
+
+    async def _sensor(self, tent: SimulatedTent, transport):
+        # Each SnifferBuddy starts at a different point in its 10 second cycle.
+        await asyncio.sleep(self.random.uniform(0, READING_SECONDS))
+        last = self.loop.time()
+        while True:
+            await asyncio.sleep(READING_SECONDS + self.random.uniform(-0.2, 0.2))
+            now = self.loop.time()
+            timestamp = START_TIMESTAMP + int(now)
+            light = 1 if (timestamp % 86400) < LIGHT_ON_HOURS * 3600 else 0
+            reading = SnifferBuddyModel(fields=tent.step(now, now - last, light), name="snifferbuddy",
+                                        tags={"location": tent.name, "name": "sniffer_one"}, timestamp=timestamp)
+            last = now
+            transport.sendto(reading.model_dump_json().encode())
+            self.readings_sent += 1
+
+    async def _run(self):
+        GlobalConfig.set_model(soak_config(self.tent_names))
+        publish = functools.partial(async_publish_single, publish_single=self.broker.publish_single)
+        # A scheduler of our own, so none of its state is shared with a loop from an earlier run.
+        scheduler = ActuationScheduler(publish)
+        tasks = []
+        for tent_name in self.tent_names:
+            for controller_type in ("VPD", "CO2"):
+                # Only one socket can have the SnifferBuddy port, so the environments share the listener below, as they
+                # do under a TentSupervisor.
+                params = GrowTentParams(monitor_param=MonitorParam.KP, tent_name=tent_name, controller_type=controller_type, ingest="none")
+                env = GrowTentEnv(params, None)
+                env.publish = publish
+                env.actuation_scheduler = scheduler
+                env.clock = self.loop.time
+                self.envs.append(env)
+                # The real start():  it makes the PID and watches for readings.
+                tasks.append(self.loop.create_task(env.start()))
+
+        async def fan_out(reading):
+            for env in self.envs:
+                await env.receive_sensor_reading_callback(reading)
+
+        listener = UDPProcessor(self.logger)
+        await listener.init_udp_listener(fan_out, SNIFFERBUDDY_PORT)
+        for tent in self.tents.values():
+            transport, _ = await self.loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=("127.0.0.1", SNIFFERBUDDY_PORT))
+            tasks.append(self.loop.create_task(self._sensor(tent, transport)))
+        await asyncio.sleep(self.days * 86400)
+        failed = [task for task in tasks if task.done() and not task.cancelled() and task.exception()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        listener.close()
+        return failed
+
+    def run(self) -> Dict[str, object]:
+        started = time.perf_counter()
+        asyncio.set_event_loop(self.loop)
+        try:
+            failed = self.loop.run_until_complete(self._run())
+            # Let the publishes still in flight finish or fail.
+            self.loop.run_until_complete(asyncio.sleep(300))
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        finally:
+            asyncio.set_event_loop(None)
+            self.loop.close()
+        digest = hashlib.sha256(repr(self.broker.log).encode()).hexdigest()[:16]
+        return {
+            "simulated_seconds": self.loop.time(),
+            "wall_seconds": time.perf_counter() - started,
+            "readings_sent": self.readings_sent,
+            "datagrams_lost": self.loop.datagrams_lost,
+            "publish_calls": self.broker.calls,
+            "publish_failures": self.broker.failures,
+            "publish_hangs": self.broker.hangs,
+            "messages_delivered": len(self.broker.log),
+            "plugs": {device: (plug.power_on_commands, plug.on_seconds(self.loop.time())) for device, plug in sorted(self.broker.plugs.items())},
+            "failed_tasks": [repr(task.exception()) for task in failed],
+            "digest": digest,
+        }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Replay simulated days of multi-tent traffic through the real pipeline on a virtual clock.")
+    parser.add_argument("--tents", type=int, default=3)
+    parser.add_argument("--days", type=float, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--failure-rate", type=float, default=0.01, help="Fraction of publishes the broker refuses.")
+    parser.add_argument("--hang-rate", type=float, default=0.002, help="Fraction of publishes that hang past the timeout.")
+    parser.add_argument("--outage", type=float, nargs=2, action="append", metavar=("START", "END"),
+                        help="Seconds into the run during which the broker is down.  Can be given more than once.")
+    parser.add_argument("--network-loss", type=float, default=0.0, help="Fraction of UDP datagrams lost.")
+    args = parser.parse_args(argv)
+
+    # Per-reading debug logging would swamp the output and the timings.
+    logging.disable(logging.CRITICAL)
+    simulation = Simulation([f"tent_{i + 1}" for i in range(args.tents)], args.days, args.seed, args.failure_rate,
+                            args.hang_rate, [tuple(outage) for outage in args.outage or []], args.network_loss)
+    report = simulation.run()
+    print(f"{report['simulated_seconds'] / 3600:.1f} simulated hours in {report['wall_seconds']:.1f} s")
+    print(f"readings sent {report['readings_sent']}, lost {report['datagrams_lost']}")
+    print(f"publishes {report['publish_calls']}, refused {report['publish_failures']}, hung {report['publish_hangs']}, "
+          f"delivered {report['messages_delivered']}")
+    for device, (power_ons, on_seconds) in report["plugs"].items():
+        print(f"  {device}: turned on {power_ons} times, on for {on_seconds:.0f} s")
+    for failure in report["failed_tasks"]:
+        print(f"task failed: {failure}")
+    print(f"digest {report['digest']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,13 @@ class SnifferBuddyQueue:
         """
         await cls._queue.put(snifferbuddy_reading)
 
+    @classmethod
+    def put_nowait(cls, snifferbuddy_reading: SnifferBuddyModel) -> None:
+        """
+        Put a SnifferBuddyModel into the queue from code that is not a coroutine (e.g. a protocol callback).
+        """
+        cls._queue.put_nowait(snifferbuddy_reading)
+
     @classmethod
     async def get(cls) -> SnifferBuddyModel:
         """
@@ -0,0 +1,213 @@
+"""
+Long-duration soak test.  Drives readings through the full ingest -> PID -> actuation loop as fast as the Pi can take
+them, simulating the 10 second SnifferBuddy rate over many days, and watches whether memory keeps growing.
+
+Once a simulated day, the harness records the traced Python heap (tracemalloc) and the process RSS.  After a warm-up,
+it fits a line through each and fails if either grows faster than its budget per simulated day.  On failure the biggest
+growth between the first and last tracemalloc snapshots is printed so the leak can be found.
+
+Example:
+    python src/soak_test_code.py --days 30
+"""
+import argparse
+import asyncio
+import gc
+import logging
+import math
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from typing import List, Tuple
+
+from actuation_scheduler_code import ActuationScheduler
+from growtent_env_code import GrowTentEnv
+from logger_code import LoggerBase
+from process_udp_code import SimpleUDPServer
+from pydantic_models import (GlobalConfig, GlobalConfigModel, GlobalSettingsModel, GrowTentConfigModel, GrowTentParams,
+                             MonitorParam, PidConfigModel, SensorDataModel, SnifferBuddyModel)
+
+READING_SECONDS = 10
+READINGS_PER_DAY = 24 * 60 * 60 // READING_SECONDS
+WARMUP_DAYS = 2
+
+
+def soak_config(tent_names: List[str]) -> GlobalConfigModel:
+    def pid_config(setpoint: float, comparison_function: str, topic: str) -> PidConfigModel:
+        return PidConfigModel(
+            active=True, hostname="soak.local", snifferbuddy_incoming_port=8095, setpoint=setpoint,
+            Kp=1.0, Ki=0.01, Kd=0.5, seconds_on_limit=[0, 60], integral_limits=[0, 30],
+            comparison_function=comparison_function, mqtt_power_topics=[topic], telegraf_fieldname="vpd",
+        )
+    return GlobalConfigModel(
+        global_settings=GlobalSettingsModel(log_level="WARNING"),
+        grow_tents=[
+            GrowTentConfigModel(
+                name=name,
+                MistBuddy=pid_config(1.0, "less_than", f"cmnd/{name}_mistbuddy/POWER"),
+                CO2Buddy=pid_config(1000, "greater_than", f"cmnd/{name}_co2buddy/POWER"),
+            )
+            for name in tent_names
+        ],
+    )
+
+
+def rss_bytes() -> int:
+    """The resident set size of this process right now."""
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Not Linux.  The peak RSS is the best we can do.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def growth_per_day(samples: List[Tuple[int, int]]) -> float:
+    """Least squares slope of (day, bytes) samples."""
+    n = len(samples)
+    mean_day = sum(day for day, _ in samples) / n
+    mean_bytes = sum(value for _, value in samples) / n
+    numerator = sum((day - mean_day) * (value - mean_bytes) for day, value in samples)
+    denominator = sum((day - mean_day) ** 2 for day, _ in samples)
+    return numerator / denominator if denominator else 0.0
+
+
+class SoakTest:
+    def __init__(self, tent_names: List[str], days: int, seed: int = 0):
+        self.logger = LoggerBase.setup_logger('SoakTest')
+        self.tent_names = tent_names
+        self.days = days
+        self.random = random.Random(seed)
+        self.actuations = 0
+        self.envs: List[GrowTentEnv] = []
+        self.server = None
+
+    async def _publish(self, host, topic, message, logger, timeout=60, max_retries=5):
+        # Stands in for async_publish_single so no broker is needed.
+        self.actuations += 1
+
+    def _setup(self):
+        GlobalConfig.set_model(soak_config(self.tent_names))
+        # The real scheduler, but with limits that don't hold back a loop running thousands of times faster than real time.
+        scheduler = ActuationScheduler(self._publish, broker_rate=1e9, broker_burst=1e9, plug_rate=1e9, plug_burst=1e9)
+        for tent_name in self.tent_names:
+            for controller_type in ("VPD", "CO2"):
+                # No jitter hold:  readings arrive far faster than real time and are already in order.
+                params = GrowTentParams(monitor_param=MonitorParam.KP, tent_name=tent_name, controller_type=controller_type, jitter_hold_seconds=0)
+                env = GrowTentEnv(params, None)
+                env.publish = self._publish
+                env.actuation_scheduler = scheduler
+                env.init_pid()
+                self.envs.append(env)
+
+        async def fan_out(reading):
+            for env in self.envs:
+                await env.receive_sensor_reading_callback(reading)
+
+        # Datagrams go straight into the real protocol object, so decoding and validation are part of the loop.
+        self.server = SimpleUDPServer(self.logger, fan_out)
+
+    def _reading(self, tent_name: str, timestamp: int) -> bytes:
+        hour = (timestamp // 3600) % 24
+        light = 1 if hour < 18 else 0
+        # Slow swings around the setpoints plus noise, so the controllers turn the plugs on some of the time.
+        phase = 2 * math.pi * (timestamp % 7200) / 7200
+        vpd = 1.0 + 0.3 * math.sin(phase) + self.random.gauss(0, 0.05)
+        co2 = 1000 + 200 * math.cos(phase) + self.random.gauss(0, 20)
+        reading = SnifferBuddyModel(
+            fields=SensorDataModel(CO2=co2, dewpoint=15.0, eCO2=co2, humidity=60.0, light=light, temperature=25.0, vpd=vpd),
+            name="snifferbuddy", tags={"location": tent_name, "name": "sniffer_one"}, timestamp=timestamp,
+        )
+        return reading.model_dump_json().encode()
+
+    async def _catch_up(self):
+        # Readings go in far faster than real time.  Let the controllers keep up so the jitter buffers don't drop any.
+        await asyncio.sleep(0)
+        while any(not env.jitter_buffer._ready.empty() for env in self.envs):
+            await asyncio.sleep(0)
+
+    def _busy(self, baseline) -> bool:
+        if asyncio.all_tasks() - baseline:
+            return True
+        if self.envs and self.envs[0].actuation_scheduler.in_flight:
+            return True
+        # Readings still held or queued in a jitter buffer would be counted as growth.
+        return any(len(env.jitter_buffer.buffer) or not env.jitter_buffer._ready.empty() for env in self.envs)
+
+    async def _drain(self):
+        # Let the tasks each reading spawned finish and the jitter buffers empty before measuring.
+        baseline = {asyncio.current_task()}
+        if self.envs and self.envs[0].actuation_scheduler._worker:
+            baseline.add(self.envs[0].actuation_scheduler._worker)
+        for env in self.envs:
+            if env.jitter_buffer._worker:
+                baseline.add(env.jitter_buffer._worker)
+        while self._busy(baseline):
+            await asyncio.sleep(0)
+
+    async def run(self, trace_memory: bool = True) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]], list]:
+        self._setup()
+        traced: List[Tuple[int, int]] = []
+        rss: List[Tuple[int, int]] = []
+        snapshots = []
+        if trace_memory:
+            tracemalloc.start(10)
+        timestamp = 1700000000
+        started = time.perf_counter()
+        for day in range(1, self.days + 1):
+            for _ in range(READINGS_PER_DAY):
+                timestamp += READING_SECONDS
+                for tent_name in self.tent_names:
+                    self.server.datagram_received(self._reading(tent_name, timestamp), ("127.0.0.1", 0))
+                await self._catch_up()
+            await self._drain()
+            gc.collect()
+            rss.append((day, rss_bytes()))
+            if trace_memory:
+                traced.append((day, tracemalloc.get_traced_memory()[0]))
+                if day == WARMUP_DAYS or day == self.days:
+                    snapshots.append(tracemalloc.take_snapshot())
+            dropped = sum(env.jitter_buffer.dropped for env in self.envs)
+            print(f"day {day:>3}: rss {rss[-1][1] / 2**20:8.2f} MiB"
+                  + (f", traced {traced[-1][1] / 2**20:8.2f} MiB" if traced else "")
+                  + f", actuations {self.actuations}, dropped {dropped}, {time.perf_counter() - started:7.1f} s")
+        if trace_memory:
+            tracemalloc.stop()
+        return traced, rss, snapshots
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Soak test the ingest -> PID -> actuation loop and check for memory growth.")
+    parser.add_argument("--days", type=int, default=30, help="Simulated days to run.")
+    parser.add_argument("--tents", type=int, default=1, help="Number of grow tents.")
+    parser.add_argument("--traced-budget", type=float, default=64 * 1024, help="Allowed growth of the Python heap in bytes per simulated day.")
+    parser.add_argument("--rss-budget", type=float, default=512 * 1024, help="Allowed RSS growth in bytes per simulated day.")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="Only watch RSS.  Runs about twice as fast.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.days <= WARMUP_DAYS + 1:
+        parser.error(f"--days must be more than {WARMUP_DAYS + 1} to leave samples after the warm-up.")
+
+    # Per-reading debug logging would swamp the output and the timings.
+    logging.disable(logging.INFO)
+    soak = SoakTest([f"tent_{i + 1}" for i in range(args.tents)], args.days, args.seed)
+    traced, rss, snapshots = asyncio.run(soak.run(not args.no_tracemalloc))
+
+    failed = False
+    for label, samples, budget in (("traced heap", traced, args.traced_budget), ("rss", rss, args.rss_budget)):
+        if not samples:
+            continue
+        slope = growth_per_day(samples[WARMUP_DAYS - 1:])
+        verdict = "ok" if slope <= budget else "FAIL"
+        failed = failed or slope > budget
+        print(f"{label:>11}: {slope / 1024:9.1f} KiB/day (budget {budget / 1024:.1f} KiB/day) {verdict}")
+    if failed and len(snapshots) == 2:
+        print("Largest growth since the end of the warm-up:")
+        for stat in snapshots[1].compare_to(snapshots[0], "traceback")[:10]:
+            print(f"  {stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+8d} blocks  {stat.traceback.format()[-1].strip()}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+from typing import Optional
+
+from signal_filter_code import RunningMean
+
+# How close to the setpoint counts as settled, in the units of what is controlled (ppm for CO2, kPa for VPD).
+SETTLE_BANDS = {"CO2": 50.0, "VPD": 0.05}
+
+
+class StepResponseMetrics:
+    """
+    Keeps the step response metrics of one controller up to date as readings come in.  Each update is constant time
+    and memory, however long the run, so the tuning phases can check whether they are done on every reading.
+
+    Tracks:
+        steady_state_error  mean error (setpoint - value) over the last `window` readings.
+        overshoot           furthest the value went past the setpoint, as a fraction of the error at the start.
+        settling_time       seconds from the start until the value last came into the band around the setpoint.  None while it is outside.
+        iae                 integrated absolute error, in error units times seconds.
+        peaks               local maxima of the value with a prominence of at least `min_prominence` of the initial error
+                            (and at least the band):  the value rose that far from the trough before the peak and fell
+                            that far after it.  Found once it has fallen that far.  Noise wiggles don't count.
+    """
+    def __init__(self, setpoint: float, band: float, window: int = 30, peak_tolerance: float = 0.05,
+                 max_overshoot: float = 0.1, settle_seconds: float = 600, min_prominence: float = 0.25):
+        """
+        Args:
+            setpoint (float): What the controller aims for.
+            band (float): How far from the setpoint still counts as settled.
+            window (int): Readings the steady state error is averaged over.
+            peak_tolerance (float): Kp tuning is done when two consecutive peaks differ by at most this fraction.
+            max_overshoot (float): Kd tuning is done only if the overshoot is at most this fraction.
+            settle_seconds (float): Kd tuning is done once the value has stayed in the band this long.
+            min_prominence (float): How far the value has to swing on both sides of a peak, as a fraction of the error
+                at the start.
+        """
+        self.setpoint = setpoint
+        self.band = band
+        self.window = window
+        self.peak_tolerance = peak_tolerance
+        self.max_overshoot = max_overshoot
+        self.settle_seconds = settle_seconds
+        self.min_prominence = min_prominence
+        self.reset()
+
+    def reset(self):
+        """Start over, e.g. when the light comes back on or the gains change."""
+        self._mean_error = RunningMean(self.window)
+        self.samples = 0
+        self.steady_state_error: Optional[float] = None
+        self.iae = 0.0
+        self._start_time: Optional[float] = None
+        self._last_time: Optional[float] = None
+        self._last_error: Optional[float] = None
+        self._initial_error: Optional[float] = None
+        self._worst_past = 0.0
+        self._in_band_since: Optional[float] = None
+        # The highest value since the last trough while looking for a peak, the lowest since the last peak otherwise.
+        self._extreme: Optional[float] = None
+        self._seeking_peak = False
+        self.peak_count = 0
+        self.last_peak: Optional[float] = None
+        self.previous_peak: Optional[float] = None
+
+    def update(self, value: float, timestamp: float):
+        error = self.setpoint - value
+        if self._start_time is None:
+            self._start_time = timestamp
+            self._initial_error = error
+        else:
+            # Trapezoid rule.  Readings come about every 10 seconds, so this is close enough for comparing runs.
+            self.iae += 0.5 * (abs(error) + abs(self._last_error)) * (timestamp - self._last_time)
+        self._last_time = timestamp
+        self._last_error = error
+        self.samples += 1
+        self.steady_state_error = self._mean_error(error)
+
+        # Past the setpoint means the error has the other sign from the one it started with.
+        if self._initial_error:
+            past = -error if self._initial_error > 0 else error
+            self._worst_past = max(self._worst_past, past)
+
+        if abs(error) <= self.band:
+            if self._in_band_since is None:
+                self._in_band_since = timestamp
+        else:
+            self._in_band_since = None
+
+        # Swings smaller than the minimum prominence are ignored:  the search for a trough turns into the search for a
+        # peak only after the value has risen that far from the lowest point, and back only after it has fallen that far
+        # from the highest, which is then the peak.
+        swing = max(self.min_prominence * abs(self._initial_error), self.band)
+        if self._extreme is None:
+            self._extreme = value
+        elif self._seeking_peak:
+            if value > self._extreme:
+                self._extreme = value
+            elif self._extreme - value >= swing:
+                self.previous_peak, self.last_peak = self.last_peak, self._extreme
+                self.peak_count += 1
+                self._seeking_peak = False
+                self._extreme = value
+        elif value < self._extreme:
+            self._extreme = value
+        elif value - self._extreme >= swing:
+            self._seeking_peak = True
+            self._extreme = value
+
+    @property
+    def overshoot(self) -> float:
+        if not self._initial_error:
+            return 0.0
+        return self._worst_past / abs(self._initial_error)
+
+    @property
+    def settling_time(self) -> Optional[float]:
+        if self._in_band_since is None:
+            return None
+        return self._in_band_since - self._start_time
+
+    @property
+    def settled_for(self) -> float:
+        """Seconds the value has stayed in the band, up to the latest reading."""
+        if self._in_band_since is None:
+            return 0.0
+        return self._last_time - self._in_band_since
+
+    def kp_done(self) -> bool:
+        """The value oscillates steadily:  the last two peaks are within peak_tolerance of each other."""
+        if self.previous_peak is None or self.previous_peak <= 0:
+            return False
+        return abs(self.last_peak - self.previous_peak) / self.previous_peak <= self.peak_tolerance
+
+    def ki_done(self) -> bool:
+        """Ki has taken out the offset:  over a full window, the mean error is inside the band."""
+        return self.samples >= self.window and abs(self.steady_state_error) <= self.band
+
+    def kd_done(self) -> bool:
+        """The response has settled without overshooting too far."""
+        return self.settled_for >= self.settle_seconds and self.overshoot <= self.max_overshoot
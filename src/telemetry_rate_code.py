@@ -0,0 +1,79 @@
+import math
+from typing import Dict, Optional, Tuple
+
+from pydantic_models import SnifferBuddyModel
+
+# Tasmota does not accept a TelePeriod under 10 seconds.
+FAST_TELEPERIOD = 10
+SLOW_TELEPERIOD = 300
+# How far from the setpoint counts as a large error, in the units of what is controlled (ppm for CO2, kPa for VPD).
+ERROR_THRESHOLDS = {"CO2": 100, "VPD": 0.15}
+
+
+def teleperiod_topic(location: str, name: str) -> str:
+    """The Tasmota command topic that sets how often the SnifferBuddy at tele/snifferbuddy/<location>/<name>/SENSOR reports."""
+    return f"cmnd/snifferbuddy/{location}/{name}/TelePeriod"
+
+
+class TelemetryRateController:
+    """
+    Decides how often each SnifferBuddy should report.  A sensor is switched to the fast rate while any controller that
+    reads it is in a tuning phase or sees a large error, and back to the slow rate once every one of those controllers
+    has been settled for `stable_seconds`.  The rate of a sensor is not changed more than once every
+    `min_change_seconds`, so a tent near the threshold does not flood the sensor with commands.
+
+    The CO2 and VPD controllers of a tent read the same SnifferBuddy, so they share one rate controller (see shared()).
+
+    Note that with the telegraf UDP ingest the 30 second basicstats window still limits what the PID sees.  The MQTT
+    ingest gets every reading.
+    """
+    _shared: Dict[str, "TelemetryRateController"] = {}
+
+    @classmethod
+    def shared(cls, hostname: str) -> "TelemetryRateController":
+        if hostname not in cls._shared:
+            cls._shared[hostname] = cls()
+        return cls._shared[hostname]
+
+    def __init__(self, fast: int = FAST_TELEPERIOD, slow: int = SLOW_TELEPERIOD, stable_seconds: float = 600, min_change_seconds: float = 60):
+        self.fast = fast
+        self.slow = slow
+        self.stable_seconds = stable_seconds
+        self.min_change_seconds = min_change_seconds
+        # Per sensor:  the TelePeriod we last set, when we set it, and when each controller last wanted the fast rate.
+        self._rates: Dict[Tuple[str, str], int] = {}
+        self._changed: Dict[Tuple[str, str], float] = {}
+        self._unsettled: Dict[Tuple[str, str], Dict[str, float]] = {}
+
+    def update(self, reading: SnifferBuddyModel, controller: str, error: float, tuning: bool) -> Optional[Tuple[str, int]]:
+        """
+        Record what one controller thinks of the latest reading.
+
+        Args:
+            reading (SnifferBuddyModel): The reading.  Its tags name the sensor and its timestamp is the clock used.
+            controller (str): The controller type, CO2 or VPD.
+            error (float): Setpoint minus the reading's value.
+            tuning (bool): True while the controller is in a tuning phase.
+
+        Returns:
+            tuple: (topic, TelePeriod) to publish if the sensor's rate should change, otherwise None.
+        """
+        sensor = (reading.tags.get("location", ""), reading.tags.get("name", ""))
+        now = reading.timestamp
+        controllers = self._unsettled.setdefault(sensor, {})
+        threshold = ERROR_THRESHOLDS.get(controller.upper(), math.inf)
+        if tuning or abs(error) > threshold:
+            controllers[controller] = now
+            target = self.fast
+        else:
+            controllers.setdefault(controller, -math.inf)
+            settled = all(now - unsettled >= self.stable_seconds for unsettled in controllers.values())
+            target = self.slow if settled else self._rates.get(sensor)
+        current = self._rates.get(sensor)
+        if target is None or target == current:
+            return None
+        if current is not None and now - self._changed[sensor] < self.min_change_seconds:
+            return None
+        self._rates[sensor] = target
+        self._changed[sensor] = now
+        return teleperiod_topic(*sensor), target
@@ -0,0 +1,158 @@
+import atexit
+from contextlib import nullcontext
+from contextvars import ContextVar
+from collections import deque
+import itertools
+import json
+import os
+import time
+from typing import Optional
+
+_NO_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ("name", "trace_id", "args", "start_ns")
+
+    def __init__(self, name: str, trace_id: int, args: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.args = args
+        self.start_ns = 0
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        Tracer.add_span(self.name, self.start_ns, time.perf_counter_ns(), self.trace_id, **self.args)
+        return False
+
+
+class _Activation:
+    __slots__ = ("trace_id", "token")
+
+    def __init__(self, trace_id: Optional[int]):
+        self.trace_id = trace_id
+        self.token = None
+
+    def __enter__(self):
+        self.token = Tracer._current.set(self.trace_id)
+        return self.trace_id
+
+    def __exit__(self, exc_type, exc, tb):
+        Tracer._current.reset(self.token)
+        return False
+
+
+class Tracer:
+    """
+    Opt-in tracing of readings through the control pipeline.  SimpleUDPServer starts a trace for every
+    `sample_every`-th datagram and the trace id follows the reading through the tasks it spawns (it lives in a
+    ContextVar, which asyncio copies into new tasks).  Code along the way wraps its work in Tracer.span(...).  When
+    the reading is not being traced, span() hands back a shared do-nothing context manager, so the cost is one
+    ContextVar lookup.
+
+    The spans are exported as Chrome trace JSON, which chrome://tracing and ui.perfetto.dev open.  Each traced reading
+    gets its own row.
+
+    Example:
+        Tracer.enable(sample_every=10, export_path="growbuddies_trace.json")
+    """
+    _enabled = False
+    _sample_every = 1
+    _datagrams = 0
+    _trace_ids = itertools.count(1)
+    _events = deque(maxlen=100000)
+    _current: ContextVar = ContextVar("growbuddies_trace_id", default=None)
+    _pid = os.getpid()
+    _export_path: Optional[str] = None
+    _exit_hook_registered = False
+
+    @classmethod
+    def enable(cls, sample_every: int = 1, max_events: int = 100000, export_path: Optional[str] = None) -> None:
+        """
+        Start tracing.
+
+        Args:
+            sample_every (int): Trace one out of this many datagrams.
+            max_events (int): How many spans to keep.  The oldest are dropped first.
+            export_path (str, optional): Write the trace to this file when the process exits.  Enabling again with
+                another path replaces it.
+        """
+        cls._enabled = True
+        cls._sample_every = max(1, sample_every)
+        cls._events = deque(cls._events, maxlen=max_events)
+        if export_path:
+            cls._export_path = export_path
+            # One hook however many times tracing is enabled, so the trace is written once.
+            if not cls._exit_hook_registered:
+                atexit.register(cls._export_at_exit)
+                cls._exit_hook_registered = True
+
+    @classmethod
+    def _export_at_exit(cls) -> None:
+        if cls._export_path:
+            cls.export(cls._export_path)
+
+    @classmethod
+    def disable(cls) -> None:
+        cls._enabled = False
+
+    @classmethod
+    def start_trace(cls) -> Optional[int]:
+        """Returns a new trace id if this datagram is sampled, otherwise None."""
+        if not cls._enabled:
+            return None
+        cls._datagrams += 1
+        if cls._datagrams % cls._sample_every:
+            return None
+        return next(cls._trace_ids)
+
+    @classmethod
+    def current(cls) -> Optional[int]:
+        return cls._current.get()
+
+    @classmethod
+    def activate(cls, trace_id: Optional[int]) -> _Activation:
+        """Make trace_id the current trace inside a with block.  Tasks created in the block carry it along."""
+        return _Activation(trace_id)
+
+    @classmethod
+    def span(cls, name: str, **args):
+        """Time the body of a with block as a span of the current trace."""
+        trace_id = cls._current.get()
+        if trace_id is None:
+            return _NO_SPAN
+        return _Span(name, trace_id, args)
+
+    @classmethod
+    def add_span(cls, name: str, start_ns: int, end_ns: int, trace_id: Optional[int] = None, **args) -> None:
+        """Record a span that was timed by hand, e.g. the time a reading waited in a queue."""
+        trace_id = trace_id if trace_id is not None else cls._current.get()
+        if trace_id is None:
+            return
+        args["trace_id"] = trace_id
+        cls._events.append({
+            "name": name,
+            "cat": "growbuddies",
+            "ph": "X",
+            "ts": start_ns / 1000,
+            "dur": (end_ns - start_ns) / 1000,
+            "pid": cls._pid,
+            "tid": trace_id,
+            "args": args,
+        })
+
+    @classmethod
+    def export(cls, path: str) -> int:
+        """
+        Write the spans recorded so far as Chrome trace JSON.
+
+        Returns:
+            int: The number of spans written.
+        """
+        events = list(cls._events)
+        with open(path, 'w', encoding="utf-8") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+        return len(events)
@@ -0,0 +1,206 @@
+import struct
+import sys
+from typing import Dict, Hashable, List, Optional, Tuple, Union
+
+from pydantic_models import SensorDataModel, SnifferBuddyModel
+
+# A compact, versioned binary encoding of SnifferBuddy readings.  It can go over the same UDP port as telegraf's JSON since
+# a JSON datagram never starts with the magic bytes.
+#
+# Every datagram starts with the magic bytes, the version and the message type.
+#   READING: location id, sensor name id, timestamp, the six float fields (as float32) and the light flag.  41 bytes.
+#   NAMES:   the number of entries, then for each entry its id, the length of the name and the utf-8 name.
+# Location and sensor names are sent once in a NAMES message and referred to by id after that.
+MAGIC = b"SB"
+VERSION = 1
+READING = 1
+NAMES = 2
+
+HEADER = struct.Struct("<2sBB")
+READING_STRUCT = struct.Struct("<2sBBHHq6fB")
+NAMES_COUNT = struct.Struct("<H")
+NAME_ENTRY = struct.Struct("<HB")
+# The order the float fields are packed in.
+FLOAT_FIELDS = ("CO2", "dewpoint", "eCO2", "humidity", "temperature", "vpd")
+
+
+def is_binary(data: bytes) -> bool:
+    return data[:2] == MAGIC
+
+
+class DecodedFields:
+    """The `fields` of a DecodedReading.  Has the attributes of SensorDataModel."""
+    __slots__ = ("CO2", "dewpoint", "eCO2", "humidity", "light", "temperature", "vpd")
+
+    def __init__(self, CO2, dewpoint, eCO2, humidity, light, temperature, vpd):
+        self.CO2 = CO2
+        self.dewpoint = dewpoint
+        self.eCO2 = eCO2
+        self.humidity = humidity
+        self.light = light
+        self.temperature = temperature
+        self.vpd = vpd
+
+
+class DecodedReading:
+    """
+    A reading decoded from the binary format.  It has the attributes of SnifferBuddyModel (fields, name, tags and
+    timestamp) but none of its methods.  The reading callbacks in this repo only read the attributes, so they take it as
+    it is (see SnifferBuddyReading).  Anything that needs the model itself calls to_model().  It is a plain object
+    because building the pydantic models, even with model_construct, took longer than parsing the JSON datagram.  The
+    binary layout already fixes the types.
+    """
+    __slots__ = ("fields", "name", "tags", "timestamp")
+
+    def __init__(self, fields: DecodedFields, tags: Dict[str, str], timestamp: int):
+        self.fields = fields
+        self.name = "snifferbuddy"
+        self.tags = tags
+        self.timestamp = timestamp
+
+    def __repr__(self) -> str:
+        return f"DecodedReading(tags={self.tags}, timestamp={self.timestamp})"
+
+    def to_model(self) -> SnifferBuddyModel:
+        """The reading as a validated SnifferBuddyModel, for code that needs the model itself."""
+        fields = {field: getattr(self.fields, field) for field in DecodedFields.__slots__}
+        return SnifferBuddyModel(fields=SensorDataModel(**fields), name=self.name, tags=dict(self.tags), timestamp=self.timestamp)
+
+
+# What the UDP listener hands its callback:  a SnifferBuddyModel for a JSON datagram, a DecodedReading for a binary one.
+SnifferBuddyReading = Union[SnifferBuddyModel, DecodedReading]
+
+
+class SnifferBuddyEncoder:
+    """
+    Packs readings into the binary format.  A sender keeps one encoder so each location and sensor name only goes over
+    the wire once.  The whole name table is sent again every `announce_every` readings so a receiver that restarts
+    picks it back up.
+    """
+    def __init__(self, announce_every: int = 100):
+        self.announce_every = announce_every
+        self._ids: Dict[str, int] = {}
+        self._since_announce = 0
+
+    def _intern(self, name: str, new_names: List[Tuple[int, str]]) -> int:
+        if name not in self._ids:
+            if len(self._ids) == 0xFFFF:
+                raise ValueError("The name table is full.")
+            self._ids[name] = len(self._ids)
+            new_names.append((self._ids[name], name))
+        return self._ids[name]
+
+    def encode(self, reading: SnifferBuddyModel) -> List[bytes]:
+        """
+        Returns:
+            list: The datagrams to send, in order.  A NAMES datagram comes first when the reading uses a new name or it is time to announce the table again.
+        """
+        new_names: List[Tuple[int, str]] = []
+        location_id = self._intern(reading.tags.get("location", ""), new_names)
+        name_id = self._intern(reading.tags.get("name", ""), new_names)
+        self._since_announce += 1
+        if self._since_announce >= self.announce_every:
+            self._since_announce = 0
+            new_names = [(name_id_, name) for name, name_id_ in self._ids.items()]
+        datagrams = [encode_names(new_names)] if new_names else []
+        fields = reading.fields
+        datagrams.append(READING_STRUCT.pack(
+            MAGIC, VERSION, READING, location_id, name_id, reading.timestamp,
+            *(getattr(fields, field) for field in FLOAT_FIELDS), fields.light
+        ))
+        return datagrams
+
+
+def encode_names(names: List[Tuple[int, str]]) -> bytes:
+    parts = [HEADER.pack(MAGIC, VERSION, NAMES), NAMES_COUNT.pack(len(names))]
+    for name_id, name in names:
+        encoded = name.encode("utf-8")
+        parts.append(NAME_ENTRY.pack(name_id, len(encoded)))
+        parts.append(encoded)
+    return b"".join(parts)
+
+
+class SnifferBuddyDecoder:
+    """
+    Unpacks binary datagrams straight out of the receive buffer through a memoryview.  The only strings made are the
+    names in NAMES messages, and those are made once and reused for every reading after that.  A name table is kept per
+    sender, since each sender numbers its names itself.
+    """
+    def __init__(self):
+        self._names: Dict[Hashable, Dict[int, str]] = {}
+        self._tags: Dict[Tuple[Hashable, int, int], Dict[str, str]] = {}
+
+    def decode(self, data: bytes, sender: Hashable = None) -> Optional[DecodedReading]:
+        """
+        Args:
+            data (bytes): The datagram.
+            sender (Hashable, optional): Who sent it, e.g. the address from datagram_received.
+
+        Returns:
+            DecodedReading: The reading, or None for a NAMES message.
+
+        Raises:
+            ValueError: If the datagram is not a version of the format we know, is cut short, or refers to a name we
+                have not been sent.
+        """
+        view = memoryview(data)
+        try:
+            magic, version, message_type = HEADER.unpack_from(view)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"Not a version {VERSION} SnifferBuddy datagram.")
+            if message_type == NAMES:
+                self._read_names(view, sender)
+                return None
+            if message_type != READING:
+                raise ValueError(f"Unknown message type {message_type}.")
+            _, _, _, location_id, name_id, timestamp, CO2, dewpoint, eCO2, humidity, temperature, vpd, light = READING_STRUCT.unpack_from(view)
+        except struct.error as e:
+            raise ValueError(f"Datagram of {len(view)} bytes is too short: {e}") from e
+        tags = self._tags.get((sender, location_id, name_id))
+        if tags is None:
+            names = self._names.get(sender, {})
+            if location_id not in names or name_id not in names:
+                raise ValueError(f"Reading refers to name ids {location_id}, {name_id} that have not been announced.")
+            tags = {"location": names[location_id], "name": names[name_id]}
+            self._tags[(sender, location_id, name_id)] = tags
+        return DecodedReading(DecodedFields(CO2, dewpoint, eCO2, humidity, light, temperature, vpd), tags, timestamp)
+
+    def _read_names(self, view: memoryview, sender: Hashable):
+        names = self._names.setdefault(sender, {})
+        offset = HEADER.size
+        (count,) = NAMES_COUNT.unpack_from(view, offset)
+        offset += NAMES_COUNT.size
+        for _ in range(count):
+            name_id, length = NAME_ENTRY.unpack_from(view, offset)
+            offset += NAME_ENTRY.size
+            name = sys.intern(str(view[offset:offset + length], "utf-8"))
+            offset += length
+            if names.get(name_id) != name:
+                names[name_id] = name
+                # Any cached tags that used the old name for this id are out of date.
+                self._tags = {key: tags for key, tags in self._tags.items() if key[0] != sender}
+
+
+def benchmark(count: int = 100000):
+    """Compare bytes per reading and decode time per reading of the binary format and telegraf JSON."""
+    import timeit
+
+    reading = SnifferBuddyModel(
+        fields=SensorDataModel(CO2=812, dewpoint=16.5, eCO2=790, humidity=58.1, light=1, temperature=25.3, vpd=1.35),
+        name="snifferbuddy", tags={"location": "tent_one", "name": "sniffer_one"}, timestamp=1711000000,
+    )
+    json_datagram = reading.model_dump_json().encode()
+    encoder = SnifferBuddyEncoder()
+    names_datagram, binary_datagram = encoder.encode(reading)
+    decoder = SnifferBuddyDecoder()
+    decoder.decode(names_datagram, "sender")
+
+    json_seconds = timeit.timeit(lambda: SnifferBuddyModel.model_validate_json(json_datagram), number=count)
+    binary_seconds = timeit.timeit(lambda: decoder.decode(binary_datagram, "sender"), number=count)
+    print(f"{'':>7} {'bytes/reading':>14} {'decode ns/reading':>18}")
+    print(f"{'json':>7} {len(json_datagram):>14} {1e9 * json_seconds / count:>18.0f}")
+    print(f"{'binary':>7} {len(binary_datagram):>14} {1e9 * binary_seconds / count:>18.0f}")
+
+
+if __name__ == "__main__":
+    benchmark()